@@ -1,105 +1,368 @@
+import csv
 import openpyxl
-import pandas as pd
+import xlsxwriter
 import os
 from datetime import datetime
 import logging
+import io
+import re
+import zipfile
+from xml.sax.saxutils import escape
+from concurrent.futures import ProcessPoolExecutor
 from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
+from openpyxl.utils import get_column_letter
+from openpyxl.xml import LXML
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# openpyxl serializa las hojas con el escritor incremental de lxml cuando está disponible;
+# sin él recurre a la implementación pura de Python, bastante más lenta
+if not LXML:
+    logger.warning("lxml no está instalado: openpyxl usará el serializador XML de Python, más lento")
+
+# Tamaño del búfer de escritura del archivo de salida: el ZIP del .xlsx se vuelca al
+# disco en pocos bloques grandes en lugar de una escritura por cada parte XML
+_WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Encabezados de las columnas del Excel, compartidos por ambos métodos de escritura
+_HEADERS_SINGLE = (
+    'Núm. Factura',
+    'Fecha',
+    'Proveedor',
+    'NIF/CIF Proveedor',
+    'Cliente',
+    'NIF/CIF Cliente',
+    'Concepto',
+    'Base Imponible',
+    'Tipo IVA',
+    'Importe IVA',
+    'Total Factura',
+    'Forma de Pago',
+    'Fecha Vencimiento'
+)
+_HEADERS_MULTI = _HEADERS_SINGLE + ('Archivo Original',)
+
+# Clave de invoice_data para cada columna de _HEADERS_SINGLE. El concepto (None) no es
+# un campo directo: se calcula a partir de los ítems de la factura
+_KEYS = (
+    'invoice_number',
+    'date',
+    'supplier_name',
+    'supplier_id',
+    'client_name',
+    'client_id',
+    None,
+    'base_amount',
+    'vat_rate',
+    'vat_amount',
+    'total',
+    'payment_method',
+    'due_date'
+)
+
+# Partes fijas del paquete OOXML generado por ExcelWriter.write_multiple_invoices_raw
+_RAW_XML_DECL = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+_RAW_CONTENT_TYPES = (
+    _RAW_XML_DECL +
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '<Override PartName="/xl/sharedStrings.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>'
+    '</Types>'
+)
+_RAW_ROOT_RELS = (
+    _RAW_XML_DECL +
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+_RAW_WORKBOOK = (
+    _RAW_XML_DECL +
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="Facturas Procesadas" sheetId="1" r:id="rId1"/></sheets>'
+    '<definedNames><definedName name="_xlnm._FilterDatabase" localSheetId="0" hidden="1">'
+    '{filter_ref}</definedName></definedNames>'
+    '</workbook>'
+)
+_RAW_WORKBOOK_RELS = (
+    _RAW_XML_DECL +
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet1.xml"/>'
+    '<Relationship Id="rId2" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+    'Target="styles.xml"/>'
+    '<Relationship Id="rId3" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings" '
+    'Target="sharedStrings.xml"/>'
+    '</Relationships>'
+)
+# Estilos: 0 = por defecto, 1 = encabezado (negrita, fondo gris, borde), 2 = celda con borde,
+# 3 = nota de pie (cursiva, tamaño 8)
+_RAW_STYLES = (
+    _RAW_XML_DECL +
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<fonts count="3">'
+    '<font><sz val="11"/><name val="Calibri"/></font>'
+    '<font><b/><sz val="11"/><name val="Calibri"/></font>'
+    '<font><i/><sz val="8"/><name val="Calibri"/></font>'
+    '</fonts>'
+    '<fills count="3">'
+    '<fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill>'
+    '<fill><patternFill patternType="solid"><fgColor rgb="FFD9D9D9"/><bgColor indexed="64"/></patternFill></fill>'
+    '</fills>'
+    '<borders count="2">'
+    '<border><left/><right/><top/><bottom/><diagonal/></border>'
+    '<border><left style="thin"/><right style="thin"/><top style="thin"/><bottom style="thin"/><diagonal/></border>'
+    '</borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="4">'
+    '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="0" fontId="1" fillId="2" borderId="1" xfId="0" applyFont="1" applyFill="1" applyBorder="1"/>'
+    '<xf numFmtId="0" fontId="0" fillId="0" borderId="1" xfId="0" applyBorder="1"/>'
+    '<xf numFmtId="0" fontId="2" fillId="0" borderId="0" xfId="0" applyFont="1"/>'
+    '</cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+_RAW_STYLE_HEADER = 1
+_RAW_STYLE_CELL = 2
+_RAW_STYLE_FOOTER = 3
+_RAW_SHEET_HEAD = (
+    _RAW_XML_DECL +
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<dimension ref="{dimension}"/>'
+    '<cols><col min="1" max="{last_col_num}" width="18" customWidth="1"/></cols>'
+    '<sheetData>'
+)
+_RAW_SHEET_TAIL = (
+    '</sheetData>'
+    '<autoFilter ref="{filter_ref}"/>'
+    '<mergeCells count="1"><mergeCell ref="{merge_ref}"/></mergeCells>'
+    '</worksheet>'
+)
+
+# Caracteres de control que XML no admite: Excel (y xlsxwriter) los guardan como _xHHHH_,
+# y para no confundirlos con texto literal con esa forma se escapa también su guion bajo
+_RE_ESCAPED_LITERAL = re.compile(r"(_x[0-9a-fA-F]{4}_)")
+_RE_CONTROL_CHARS = re.compile(r"([\x00-\x08\x0b-\x1f])")
+
+def _escape_text(text):
+    """
+    Escapa un texto para el XML del Excel igual que xlsxwriter: caracteres de control como
+    _xHHHH_ y después las entidades XML
+    """
+    text = _RE_ESCAPED_LITERAL.sub(r"_x005F\1", text)
+    text = _RE_CONTROL_CHARS.sub(lambda match: f"_x{ord(match.group(1)):04X}_", text)
+    return escape(text.replace("\ufffe", "_xFFFE_").replace("\uffff", "_xFFFF_"))
+
+class _SharedStrings:
+    """Tabla de cadenas compartidas (xl/sharedStrings.xml): cada texto distinto se guarda una vez"""
+    
+    def __init__(self):
+        self.indices = {}
+        self.total = 0
+    
+    def index(self, text):
+        """
+        Devuelve el índice de la cadena en la tabla, añadiéndola si es nueva
+        """
+        self.total += 1
+        return self.indices.setdefault(text, len(self.indices))
+    
+    def to_xml(self):
+        """
+        Serializa la tabla en el formato de xl/sharedStrings.xml
+        """
+        parts = [
+            _RAW_XML_DECL,
+            '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            f'count="{self.total}" uniqueCount="{len(self.indices)}">'
+        ]
+        for text in self.indices:
+            space = ' xml:space="preserve"' if text != text.strip() else ''
+            parts.append(f'<si><t{space}>{_escape_text(text)}</t></si>')
+        parts.append('</sst>')
+        return ''.join(parts)
+
+def _raw_cell(ref, value, style, shared):
+    """
+    Serializa una celda de la hoja como XML: vacía, booleana, numérica o referencia a una
+    cadena compartida
+    """
+    if value is None or value == '':
+        return f'<c r="{ref}" s="{style}"/>'
+    # bool es subclase de int, pero Excel lo guarda con su propio tipo (1/0)
+    if isinstance(value, bool):
+        return f'<c r="{ref}" s="{style}" t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c r="{ref}" s="{style}"><v>{value}</v></c>'
+    return f'<c r="{ref}" s="{style}" t="s"><v>{shared.index(str(value))}</v></c>'
+
+def _write_shard(invoice_list, shard_path):
+    """
+    Escribe un fragmento de facturas en su propio archivo Excel (ejecutado en un proceso hijo)
+    """
+    return ExcelWriter().write_multiple_invoices(invoice_list, shard_path)
+
 class ExcelWriter:
     """Genera archivos Excel a partir de datos extraídos de facturas"""
     
-    def write_invoice_to_excel(self, invoice_data, output_path=None, ocr_results=None, image=None):
+    # Estilos compartidos por todas las celdas (openpyxl), creados una única vez
+    _THIN = Side(style='thin')
+    _BORDER = Border(left=_THIN, right=_THIN, top=_THIN, bottom=_THIN)
+    _HEADER_FONT = Font(bold=True)
+    _HEADER_FILL = PatternFill(start_color='D9D9D9', end_color='D9D9D9', fill_type='solid')
+    _FOOTER_FONT = Font(italic=True, size=8)
+    
+    # Letras de columna precalculadas para no repetir la conversión en cada escritura
+    _COL_LETTERS = tuple(get_column_letter(col) for col in range(1, 27))
+    
+    # Propiedades de los formatos equivalentes en xlsxwriter
+    _HEADER_FORMAT = {'bold': True, 'bg_color': '#D9D9D9', 'border': 1}
+    _CELL_FORMAT = {'border': 1}
+    _FOOTER_FORMAT = {'italic': True, 'font_size': 8}
+    
+    def __init__(self, output_path=None):
+        """
+        Inicializa el generador de Excel
+        
+        Args:
+            output_path: Ruta del workbook compartido cuando se usa como gestor de contexto
+                (opcional); cada llamada a write_invoice_to_excel dentro del bloque with añade
+                una hoja a ese único archivo
+        """
+        self.output_path = output_path
+        self._wb = None
+        self._formats = None
+        
+        # Estado del Excel consolidado en modo streaming (ver open/append_invoice/close)
+        self._stream_path = None
+        self._stream_file = None
+        self._stream_csv = None
+        self._stream_wb = None
+        self._stream_ws = None
+        self._stream_formats = None
+        self._stream_rows = 0
+        self._stream_now = None
+    
+    def __enter__(self):
+        """
+        Abre el workbook compartido y crea sus formatos una sola vez para todo el lote
+        """
+        if not self.output_path:
+            self.output_path = f"facturas_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+        
+        logger.info("Abriendo workbook compartido: %s", self.output_path)
+        self._wb = xlsxwriter.Workbook(self.output_path, {'strings_to_numbers': False})
+        self._formats = (
+            self._wb.add_format(ExcelWriter._HEADER_FORMAT),
+            self._wb.add_format(ExcelWriter._CELL_FORMAT),
+            self._wb.add_format(ExcelWriter._FOOTER_FORMAT)
+        )
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Cierra el workbook compartido, escribiendo el archivo completo de una vez
+        """
+        self._wb.close()
+        logger.info("Workbook compartido generado exitosamente: %s", self.output_path)
+        self._wb = None
+        self._formats = None
+        return False
+    
+    def write_invoice_to_excel(self, invoice_data, output_path=None, ocr_results=None, image=None,
+                               sheet_name=None):
         """
         Genera un archivo Excel con la información de una única factura
         
         Args:
             invoice_data: Diccionario con datos extraídos de la factura
-            output_path: Ruta donde guardar el archivo Excel (opcional)
+            output_path: Ruta donde guardar el archivo Excel (opcional); con extensión .csv
+                se genera un CSV sin estilos, mucho más rápido de escribir. No admitido
+                dentro de un bloque with, donde la factura se añade al workbook compartido
             ocr_results: Resultados del OCR (opcional)
             image: Imagen original de la factura (opcional)
+            sheet_name: Nombre de la hoja cuando se escribe en el workbook compartido (opcional)
             
         Returns:
             str: Ruta al archivo Excel generado
+            
+        Raises:
+            ValueError: Si se indica output_path con el workbook compartido abierto
         """
+        # Una única lectura del reloj para el nombre del archivo y la nota de procesamiento
+        now = datetime.now()
+        
+        # Dentro de un bloque with, la factura se añade como hoja del workbook compartido
+        if self._wb is not None:
+            if output_path:
+                raise ValueError(
+                    f"output_path ({output_path}) no se admite dentro de un bloque with: "
+                    f"la factura se escribe en el workbook compartido {self.output_path}"
+                )
+            return self._add_invoice_sheet(invoice_data, sheet_name, now)
+        
         # Generar nombre de archivo si no se proporciona
         if not output_path:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            timestamp = now.strftime("%Y%m%d_%H%M%S")
             invoice_num = invoice_data.get('invoice_number', 'unknown')
             output_path = f"factura_{invoice_num}_{timestamp}.xlsx"
         
-        logger.info(f"Generando archivo Excel para factura individual: {output_path}")
+        logger.info("Generando archivo Excel para factura individual: %s", output_path)
+        
+        # Escribir datos extraídos
+        row_data = self._build_row(invoice_data)
+        
+        # Ruta rápida: CSV sin estilos cuando no se pide un .xlsx
+        if output_path.lower().endswith('.csv'):
+            return self._write_csv(_HEADERS_SINGLE, [row_data], output_path)
         
         # Crear un workbook de Excel
         wb = openpyxl.Workbook()
         ws = wb.active
         ws.title = "Datos Extraídos"
         
-        # Crear encabezados como campos genéricos para facturas
-        headers = [
-            'Núm. Factura', 
-            'Fecha', 
-            'Proveedor',
-            'NIF/CIF Proveedor', 
-            'Cliente', 
-            'NIF/CIF Cliente',
-            'Concepto',
-            'Base Imponible',
-            'Tipo IVA',
-            'Importe IVA',
-            'Total Factura',
-            'Forma de Pago',
-            'Fecha Vencimiento'
-        ]
+        headers = _HEADERS_SINGLE
         
         # Escribir encabezados
-        for col_num, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col_num)
-            cell.value = header
-            cell.font = Font(bold=True)
-            cell.fill = PatternFill(start_color='D9D9D9', end_color='D9D9D9', fill_type='solid')
-            cell.border = Border(left=Side(style='thin'), right=Side(style='thin'),
-                                 top=Side(style='thin'), bottom=Side(style='thin'))
+        ws.append(headers)
+        for cell in ws[ws.max_row]:
+            cell.font = ExcelWriter._HEADER_FONT
+            cell.fill = ExcelWriter._HEADER_FILL
+            cell.border = ExcelWriter._BORDER
         
-        # Escribir datos extraídos
-        row_data = [
-            invoice_data.get('invoice_number', ''),
-            invoice_data.get('date', ''),
-            invoice_data.get('supplier_name', ''),
-            invoice_data.get('supplier_id', ''),
-            invoice_data.get('client_name', ''),
-            invoice_data.get('client_id', ''),
-            self._get_concept_text(invoice_data),
-            invoice_data.get('base_amount', ''),
-            invoice_data.get('vat_rate', ''),
-            invoice_data.get('vat_amount', ''),
-            invoice_data.get('total', ''),
-            invoice_data.get('payment_method', ''),
-            invoice_data.get('due_date', '')
-        ]
-        
-        # Escribir datos en la fila 2
-        for col_num, value in enumerate(row_data, 1):
-            cell = ws.cell(row=2, column=col_num)
-            cell.value = value
-            cell.border = Border(left=Side(style='thin'), right=Side(style='thin'),
-                                 top=Side(style='thin'), bottom=Side(style='thin'))
+        # Escribir datos en la fila 2 añadiendo la fila completa de una vez
+        ws.append(row_data)
+        for cell in ws[ws.max_row]:
+            cell.border = ExcelWriter._BORDER
         
         # Ajustar ancho de las columnas
-        for col in range(1, len(headers) + 1):
-            ws.column_dimensions[openpyxl.utils.get_column_letter(col)].width = 18
+        for letter in ExcelWriter._COL_LETTERS[:len(headers)]:
+            ws.column_dimensions[letter].width = 18
         
-        # Añadir nota de procesamiento
+        # Añadir nota de procesamiento (sin combinar celdas: el texto desborda a la derecha)
         footer_row = 4
-        ws.cell(row=footer_row, column=1).value = f"Procesado: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-        ws.cell(row=footer_row, column=1).font = Font(italic=True, size=8)
-        ws.merge_cells(f'A{footer_row}:C{footer_row}')
+        footer_text = f"Procesado: {now.strftime('%Y-%m-%d %H:%M:%S')}"
+        ws.cell(row=footer_row, column=1, value=footer_text).font = ExcelWriter._FOOTER_FONT
         
-        # Guardar
-        wb.save(output_path)
-        logger.info(f"Archivo Excel generado exitosamente: {output_path}")
+        # Guardar a través de un búfer grande para agrupar las escrituras a disco
+        with open(output_path, 'wb', buffering=_WRITE_BUFFER_SIZE) as output_file:
+            wb.save(output_file)
+        logger.info("Archivo Excel generado exitosamente: %s", output_path)
         return output_path
     
     def write_multiple_invoices(self, invoice_list, output_path=None):
@@ -108,103 +371,385 @@ class ExcelWriter:
         
         Args:
             invoice_list: Lista de diccionarios, cada uno con datos de una factura
-            output_path: Ruta donde guardar el archivo Excel
+            output_path: Ruta donde guardar el archivo Excel; con extensión .csv se genera
+                un CSV sin estilos, mucho más rápido de escribir
             
         Returns:
             str: Ruta al archivo Excel generado
         """
+        # Una única lectura del reloj para el nombre del archivo y la nota de procesamiento
+        now = datetime.now()
+        
         # Generar nombre de archivo si no se proporciona
+        if not output_path:
+            timestamp = now.strftime("%Y%m%d_%H%M%S")
+            output_path = f"facturas_procesadas_{timestamp}.xlsx"
+        
+        logger.info("Generando archivo Excel para %d facturas: %s", len(invoice_list), output_path)
+        
+        # Resolver los datos por columnas antes de escribir, separado de la emisión de celdas
+        columns = self._build_columns(invoice_list)
+        
+        # Ruta rápida: CSV sin estilos cuando no se pide un .xlsx
+        if output_path.lower().endswith('.csv'):
+            return self._write_csv(_HEADERS_MULTI, zip(*columns), output_path)
+        
+        with open(output_path, 'wb', buffering=_WRITE_BUFFER_SIZE) as output_file:
+            # Crear un workbook con xlsxwriter en modo constant_memory: cada fila se vuelca
+            # a disco al empezar la siguiente, por lo que las filas deben escribirse en orden
+            wb = xlsxwriter.Workbook(output_file, {'constant_memory': True, 'strings_to_numbers': False})
+            ws = wb.add_worksheet("Facturas Procesadas")
+            
+            # Crear los formatos una sola vez, fuera de los bucles de escritura
+            header_fmt = wb.add_format(ExcelWriter._HEADER_FORMAT)
+            cell_fmt = wb.add_format(ExcelWriter._CELL_FORMAT)
+            footer_fmt = wb.add_format(ExcelWriter._FOOTER_FORMAT)
+            
+            headers = _HEADERS_MULTI
+            
+            # Escribir encabezados
+            ws.write_row(0, 0, headers, header_fmt)
+            
+            # Elegir el método de escritura de cada columna una sola vez según sus valores,
+            # en lugar de dejar que xlsxwriter inspeccione el tipo de cada celda
+            col_writers = [self._column_writer(ws, values) for values in columns]
+            
+            # Escribir cada factura en una fila
+            for row_num, row_data in enumerate(zip(*columns), 1):
+                for col_num, (write, value) in enumerate(zip(col_writers, row_data)):
+                    if value is None or value == '':
+                        ws.write_blank(row_num, col_num, None, cell_fmt)
+                    else:
+                        write(row_num, col_num, value, cell_fmt)
+            
+            # Aplicar filtro a la tabla
+            ws.autofilter(0, 0, len(invoice_list), len(headers) - 1)
+            
+            # Ajustar ancho de las columnas
+            ws.set_column(0, len(headers) - 1, 18)
+            
+            # Añadir información de procesamiento (última fila escrita, tras todas las facturas)
+            footer_row = len(invoice_list) + 2
+            footer_text = f"Procesado: {now.strftime('%Y-%m-%d %H:%M:%S')} - Total facturas: {len(invoice_list)}"
+            ws.merge_range(footer_row, 0, footer_row, 3, footer_text, footer_fmt)
+            
+            # Guardar (el ZIP se escribe a través del búfer del archivo de salida)
+            wb.close()
+        
+        logger.info("Archivo Excel con múltiples facturas generado exitosamente: %s", output_path)
+        return output_path
+    
+    def write_multiple_invoices_parallel(self, invoice_list, output_path=None, n_workers=None):
+        """
+        Genera varios archivos Excel en paralelo, repartiendo las facturas en fragmentos
+        consecutivos que se escriben cada uno en un proceso independiente
+        
+        Args:
+            invoice_list: Lista de diccionarios, cada uno con datos de una factura
+            output_path: Ruta base para los archivos Excel; cada fragmento añade el sufijo _parteN
+            n_workers: Número de procesos a utilizar (por defecto, número de CPUs)
+            
+        Returns:
+            list: Rutas a los archivos Excel generados, en el orden de las facturas
+        """
         if not output_path:
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             output_path = f"facturas_procesadas_{timestamp}.xlsx"
         
-        logger.info(f"Generando archivo Excel para {len(invoice_list)} facturas: {output_path}")
+        n_workers = max(1, min(n_workers or os.cpu_count() or 1, len(invoice_list)))
+        if n_workers == 1:
+            return [self.write_multiple_invoices(invoice_list, output_path)]
         
-        # Crear un workbook
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = "Facturas Procesadas"
-        
-        # Crear encabezados como campos genéricos para facturas
-        headers = [
-            'Núm. Factura', 
-            'Fecha', 
-            'Proveedor',
-            'NIF/CIF Proveedor', 
-            'Cliente', 
-            'NIF/CIF Cliente',
-            'Concepto',
-            'Base Imponible',
-            'Tipo IVA',
-            'Importe IVA',
-            'Total Factura',
-            'Forma de Pago',
-            'Fecha Vencimiento',
-            'Archivo Original'
+        # Dividir en fragmentos consecutivos para conservar el orden de las facturas
+        chunk_size = -(-len(invoice_list) // n_workers)
+        base, ext = os.path.splitext(output_path)
+        shards = [
+            (invoice_list[start:start + chunk_size], f"{base}_parte{num}{ext}")
+            for num, start in enumerate(range(0, len(invoice_list), chunk_size), 1)
         ]
         
-        # Escribir encabezados
-        for col_num, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col_num)
-            cell.value = header
-            cell.font = Font(bold=True)
-            cell.fill = PatternFill(start_color='D9D9D9', end_color='D9D9D9', fill_type='solid')
-            cell.border = Border(left=Side(style='thin'), right=Side(style='thin'),
-                                  top=Side(style='thin'), bottom=Side(style='thin'))
-        
-        # Escribir cada factura en una fila
-        for row_num, invoice_data in enumerate(invoice_list, 2):
-            row_data = [
-                invoice_data.get('invoice_number', ''),
-                invoice_data.get('date', ''),
-                invoice_data.get('supplier_name', ''),
-                invoice_data.get('supplier_id', ''),
-                invoice_data.get('client_name', ''),
-                invoice_data.get('client_id', ''),
-                self._get_concept_text(invoice_data),
-                invoice_data.get('base_amount', ''),
-                invoice_data.get('vat_rate', ''),
-                invoice_data.get('vat_amount', ''),
-                invoice_data.get('total', ''),
-                invoice_data.get('payment_method', ''),
-                invoice_data.get('due_date', ''),
-                invoice_data.get('metadata', {}).get('file', '') if 'metadata' in invoice_data else ''
-            ]
-            
-            # Escribir datos en la fila
-            for col_num, value in enumerate(row_data, 1):
-                cell = ws.cell(row=row_num, column=col_num)
-                cell.value = value
-                cell.border = Border(left=Side(style='thin'), right=Side(style='thin'),
-                                     top=Side(style='thin'), bottom=Side(style='thin'))
-        
-        # Aplicar filtro a la tabla
-        ws.auto_filter.ref = f"A1:{openpyxl.utils.get_column_letter(len(headers))}{len(invoice_list) + 1}"
+        logger.info("Generando %d archivos Excel en paralelo para %d facturas", len(shards), len(invoice_list))
         
-        # Ajustar ancho de las columnas
-        for col in range(1, len(headers) + 1):
-            ws.column_dimensions[openpyxl.utils.get_column_letter(col)].width = 18
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            return list(executor.map(_write_shard, *zip(*shards)))
+    
+    def write_multiple_invoices_raw(self, invoice_list, output_path=None):
+        """
+        Genera el Excel consolidado escribiendo directamente el XML de la hoja dentro del ZIP,
+        sin pasar por el modelo de objetos de openpyxl ni de xlsxwriter
         
-        # Añadir información de procesamiento
+        Args:
+            invoice_list: Lista de diccionarios, cada uno con datos de una factura
+            output_path: Ruta donde guardar el archivo Excel
+            
+        Returns:
+            str: Ruta al archivo Excel generado
+        """
+        now = datetime.now()
+        
+        # Generar nombre de archivo si no se proporciona
+        if not output_path:
+            timestamp = now.strftime("%Y%m%d_%H%M%S")
+            output_path = f"facturas_procesadas_{timestamp}.xlsx"
+        
+        logger.info("Generando archivo Excel (XML directo) para %d facturas: %s", len(invoice_list), output_path)
+        
+        columns = self._build_columns(invoice_list)
+        headers = _HEADERS_MULTI
+        letters = ExcelWriter._COL_LETTERS[:len(headers)]
+        last_col = letters[-1]
+        last_row = len(invoice_list) + 1
         footer_row = len(invoice_list) + 3
-        ws.cell(row=footer_row, column=1).value = f"Procesado: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Total facturas: {len(invoice_list)}"
-        ws.cell(row=footer_row, column=1).font = Font(italic=True, size=8)
-        ws.merge_cells(f'A{footer_row}:D{footer_row}')
+        footer_text = f"Procesado: {now.strftime('%Y-%m-%d %H:%M:%S')} - Total facturas: {len(invoice_list)}"
+        filter_ref = f"'Facturas Procesadas'!$A$1:${last_col}${last_row}"
+        
+        # Proveedores, NIF, tipos de IVA, fechas... se repiten entre facturas: se guardan una
+        # sola vez en la tabla de cadenas compartidas y las celdas solo llevan su índice
+        shared = _SharedStrings()
+        
+        with open(output_path, 'wb', buffering=_WRITE_BUFFER_SIZE) as output_file, \
+                zipfile.ZipFile(output_file, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('[Content_Types].xml', _RAW_CONTENT_TYPES)
+            archive.writestr('_rels/.rels', _RAW_ROOT_RELS)
+            archive.writestr('xl/workbook.xml', _RAW_WORKBOOK.format(filter_ref=escape(filter_ref)))
+            archive.writestr('xl/_rels/workbook.xml.rels', _RAW_WORKBOOK_RELS)
+            archive.writestr('xl/styles.xml', _RAW_STYLES)
+            
+            # La hoja se genera fila a fila en streaming dentro del ZIP
+            with io.TextIOWrapper(archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True),
+                                  encoding='utf-8') as sheet:
+                sheet.write(_RAW_SHEET_HEAD.format(dimension=f"A1:{last_col}{footer_row}",
+                                                   last_col_num=len(headers)))
+                
+                sheet.write('<row r="1">')
+                for letter, header in zip(letters, headers):
+                    sheet.write(_raw_cell(f"{letter}1", header, _RAW_STYLE_HEADER, shared))
+                sheet.write('</row>')
+                
+                for row_num, row_data in enumerate(zip(*columns), 2):
+                    sheet.write(f'<row r="{row_num}">')
+                    for letter, value in zip(letters, row_data):
+                        sheet.write(_raw_cell(f"{letter}{row_num}", value, _RAW_STYLE_CELL, shared))
+                    sheet.write('</row>')
+                
+                sheet.write(f'<row r="{footer_row}">')
+                sheet.write(_raw_cell(f"A{footer_row}", footer_text, _RAW_STYLE_FOOTER, shared))
+                sheet.write('</row>')
+                
+                sheet.write(_RAW_SHEET_TAIL.format(filter_ref=f"A1:{last_col}{last_row}",
+                                                   merge_ref=f"A{footer_row}:D{footer_row}"))
+            
+            # La tabla de cadenas solo está completa tras recorrer toda la hoja
+            archive.writestr('xl/sharedStrings.xml', shared.to_xml())
+        
+        logger.debug("Cadenas compartidas: %d únicas de %d celdas de texto", len(shared.indices), shared.total)
+        logger.info("Archivo Excel con múltiples facturas generado exitosamente: %s", output_path)
+        return output_path
+    
+    def open(self, output_path=None):
+        """
+        Abre un Excel consolidado en modo streaming: cada factura añadida con append_invoice
+        se escribe en ese momento como una fila, sin acumular las facturas en memoria
+        
+        Args:
+            output_path: Ruta donde guardar el archivo Excel; con extensión .csv se genera
+                un CSV sin estilos
+            
+        Returns:
+            str: Ruta al archivo abierto
+        """
+        if self._stream_file is not None:
+            raise RuntimeError(f"Ya hay un Excel consolidado abierto: {self._stream_path}")
+        
+        self._stream_now = datetime.now()
+        if not output_path:
+            timestamp = self._stream_now.strftime("%Y%m%d_%H%M%S")
+            output_path = f"facturas_procesadas_{timestamp}.xlsx"
+        
+        logger.info("Abriendo Excel consolidado en modo streaming: %s", output_path)
+        self._stream_path = output_path
+        self._stream_rows = 0
+        
+        if output_path.lower().endswith('.csv'):
+            self._stream_file = open(output_path, 'w', newline='', encoding='utf-8',
+                                     buffering=_WRITE_BUFFER_SIZE)
+            self._stream_csv = csv.writer(self._stream_file)
+            self._stream_csv.writerow(_HEADERS_MULTI)
+            return output_path
+        
+        # constant_memory: cada fila se vuelca a disco al empezar la siguiente
+        self._stream_file = open(output_path, 'wb', buffering=_WRITE_BUFFER_SIZE)
+        self._stream_wb = xlsxwriter.Workbook(self._stream_file, {'constant_memory': True, 'strings_to_numbers': False})
+        self._stream_ws = self._stream_wb.add_worksheet("Facturas Procesadas")
+        self._stream_formats = (
+            self._stream_wb.add_format(ExcelWriter._CELL_FORMAT),
+            self._stream_wb.add_format(ExcelWriter._FOOTER_FORMAT)
+        )
+        self._stream_ws.write_row(0, 0, _HEADERS_MULTI, self._stream_wb.add_format(ExcelWriter._HEADER_FORMAT))
+        self._stream_ws.set_column(0, len(_HEADERS_MULTI) - 1, 18)
+        return output_path
+    
+    def append_invoice(self, invoice_data):
+        """
+        Escribe una factura como la siguiente fila del Excel consolidado abierto con open
+        
+        Args:
+            invoice_data: Diccionario con datos extraídos de la factura
+        """
+        if self._stream_file is None:
+            raise RuntimeError("No hay ningún Excel consolidado abierto: llame antes a open()")
+        
+        row_data = self._build_row(invoice_data)
+        row_data.append((invoice_data.get('metadata') or {}).get('file', ''))
+        self._stream_rows += 1
+        
+        if self._stream_csv is not None:
+            self._stream_csv.writerow(row_data)
+            return
+        
+        ws = self._stream_ws
+        cell_fmt = self._stream_formats[0]
+        row_num = self._stream_rows
+        for col_num, value in enumerate(row_data):
+            if value is None or value == '':
+                ws.write_blank(row_num, col_num, None, cell_fmt)
+            elif isinstance(value, str):
+                ws.write_string(row_num, col_num, value, cell_fmt)
+            else:
+                ws.write(row_num, col_num, value, cell_fmt)
+    
+    def close(self):
+        """
+        Cierra el Excel consolidado abierto con open, añadiendo el filtro y la nota de pie
+        
+        Returns:
+            str: Ruta al archivo Excel generado
+        """
+        if self._stream_file is None:
+            raise RuntimeError("No hay ningún Excel consolidado abierto: llame antes a open()")
+        
+        output_path = self._stream_path
+        try:
+            if self._stream_wb is not None:
+                ws = self._stream_ws
+                ws.autofilter(0, 0, self._stream_rows, len(_HEADERS_MULTI) - 1)
+                
+                footer_row = self._stream_rows + 2
+                footer_text = (f"Procesado: {self._stream_now.strftime('%Y-%m-%d %H:%M:%S')}"
+                               f" - Total facturas: {self._stream_rows}")
+                ws.merge_range(footer_row, 0, footer_row, 3, footer_text, self._stream_formats[1])
+                self._stream_wb.close()
+        finally:
+            self._stream_file.close()
+            self._stream_file = None
+            self._stream_csv = None
+            self._stream_wb = None
+            self._stream_ws = None
+            self._stream_formats = None
+        
+        logger.info("Archivo Excel con %d facturas generado exitosamente: %s", self._stream_rows, output_path)
+        return output_path
+    
+    def _add_invoice_sheet(self, invoice_data, sheet_name, now):
+        """
+        Añade una factura como hoja nueva del workbook compartido abierto con __enter__
+        
+        Args:
+            invoice_data: Diccionario con datos extraídos de la factura
+            sheet_name: Nombre de la hoja (opcional, por defecto "Factura N")
+            now: Momento de procesamiento para la nota de pie
+            
+        Returns:
+            str: Ruta al workbook compartido
+        """
+        header_fmt, cell_fmt, footer_fmt = self._formats
+        ws = self._wb.add_worksheet(sheet_name or f"Factura {len(self._wb.worksheets()) + 1}")
+        
+        ws.write_row(0, 0, _HEADERS_SINGLE, header_fmt)
+        ws.write_row(1, 0, self._build_row(invoice_data), cell_fmt)
+        ws.set_column(0, len(_HEADERS_SINGLE) - 1, 18)
+        ws.write(3, 0, f"Procesado: {now.strftime('%Y-%m-%d %H:%M:%S')}", footer_fmt)
+        
+        logger.info("Factura añadida como hoja '%s' en %s", ws.get_name(), self.output_path)
+        return self.output_path
+    
+    def _build_row(self, invoice_data):
+        """
+        Construye la fila de valores de una factura en el orden de _HEADERS_SINGLE
+        """
+        return [
+            invoice_data.get(key, '') if key else self._get_concept_text(invoice_data)
+            for key in _KEYS
+        ]
+    
+    def _build_columns(self, invoice_list):
+        """
+        Resuelve los valores del Excel consolidado por columnas: cada campo se extrae de todas
+        las facturas en una sola pasada
+        
+        Args:
+            invoice_list: Lista de diccionarios, cada uno con datos de una factura
+            
+        Returns:
+            list: Una lista de valores por cada columna de _HEADERS_MULTI
+        """
+        def column(key):
+            if key is None:
+                return [self._get_concept_text(invoice_data) for invoice_data in invoice_list]
+            return [invoice_data.get(key, '') for invoice_data in invoice_list]
+        
+        columns = [column(key) for key in _KEYS]
+        columns.append([(invoice_data.get('metadata') or {}).get('file', '') for invoice_data in invoice_list])
+        return columns
+    
+    def _column_writer(self, ws, values):
+        """
+        Devuelve el método de escritura de xlsxwriter adecuado para una columna completa
+        
+        Args:
+            ws: Hoja de xlsxwriter
+            values: Valores de la columna
+            
+        Returns:
+            callable: write_string o write_number si todos los valores no vacíos son de ese
+            tipo, o el write genérico en caso contrario
+        """
+        present = [value for value in values if value is not None and value != '']
+        if all(isinstance(value, str) for value in present):
+            return ws.write_string
+        if all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in present):
+            return ws.write_number
+        return ws.write
+    
+    def _write_csv(self, headers, rows, output_path):
+        """
+        Escribe los encabezados y las filas en un archivo CSV, sin estilos ni contenedor ZIP
+        
+        Args:
+            headers: Encabezados de las columnas
+            rows: Iterable de filas con los valores de cada columna
+            output_path: Ruta donde guardar el archivo CSV
+            
+        Returns:
+            str: Ruta al archivo CSV generado
+        """
+        with open(output_path, 'w', newline='', encoding='utf-8', buffering=_WRITE_BUFFER_SIZE) as output_file:
+            writer = csv.writer(output_file)
+            writer.writerow(headers)
+            writer.writerows(rows)
         
-        # Guardar
-        wb.save(output_path)
-        logger.info(f"Archivo Excel con múltiples facturas generado exitosamente: {output_path}")
+        logger.info("Archivo CSV generado exitosamente: %s", output_path)
         return output_path
     
     def _get_concept_text(self, invoice_data):
         """
         Extrae el concepto principal de la factura basado en los ítems
         """
-        if 'items' in invoice_data and invoice_data['items']:
+        if items := invoice_data.get('items'):
             # Usar el primer ítem o concatenar si hay varios
-            if len(invoice_data['items']) == 1:
-                return invoice_data['items'][0].get('description', '')
+            if len(items) == 1:
+                return items[0].get('description', '')
             else:
                 # Si hay múltiples ítems, mostrar el primero con indicador
-                return f"{invoice_data['items'][0].get('description', '')} y {len(invoice_data['items'])-1} conceptos más"
+                return f"{items[0].get('description', '')} y {len(items)-1} conceptos más"
         return ''
\ No newline at end of file
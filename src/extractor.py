@@ -1,13 +1,90 @@
-import torch
-from transformers import LayoutLMv2ForTokenClassification
 import re
 import logging
-from collections import defaultdict
+from functools import cached_property
 import numpy as np
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Campos que, si los patrones resuelven, hacen innecesario el análisis de contexto espacial
+_CAMPOS_OBLIGATORIOS = ('invoice_number', 'date', 'total', 'client_id')
+
+# Número de zonas verticales del documento (superior, media, inferior)
+_NUM_ZONAS = 3
+
+# Alto en píxeles de las franjas en que se agrupan los centros verticales de las cajas para
+# considerar que varios tokens están en la misma línea, absorbiendo la deriva del OCR
+_LINE_BUCKET_PX = 8
+
+# Expresiones regulares usadas token a token, compiladas una sola vez
+_RE_DATE = re.compile(r'\d{1,2}/\d{1,2}/\d{2,4}')
+_RE_AMOUNT = re.compile(r'\d{1,3}(?:\.\d{3})*,\d{2}')
+_RE_INV_SHAPE = re.compile(r'\d{1,2}/\d{1,2}')
+_RE_INV_SIMPLE = re.compile(r'\d{2,6}')
+_RE_CODE = re.compile(r'[A-Za-z0-9]{3,8}')
+_RE_DEC = re.compile(r'\d+[.,]\d{2}')
+
+# Mismos patrones anclados al inicio de cada línea, para clasificar de una sola pasada
+# todos los tokens unidos con saltos de línea (equivale a aplicar match a cada palabra)
+_RE_AMOUNT_TOKENS = re.compile('^' + _RE_AMOUNT.pattern, re.MULTILINE)
+_RE_CODE_TOKENS = re.compile('^' + _RE_CODE.pattern, re.MULTILINE)
+_RE_DEC_TOKENS = re.compile('^' + _RE_DEC.pattern, re.MULTILINE)
+
+# Palabras ancla que localizan cada sección: las primeras se buscan en mayúsculas y las
+# de inicio de la tabla de detalle, tal cual aparecen en el OCR
+_ANCLAS_MAYUSCULAS = ("FACTURA", "FECHA", "CLIENTE", "LIQUIDO", "TOTAL")
+_ANCLAS_TABLA = ("__DESCRIPCION", "CONCEPTO", "CARGOS")
+
+def _find_anchors(words, uppers):
+    """
+    Localiza en una sola pasada la primera aparición de cada palabra ancla
+    
+    Args:
+        words: Palabras del OCR
+        uppers: Las mismas palabras en mayúsculas
+        
+    Returns:
+        dict: Mapa palabra ancla -> índice del primer token que la contiene
+    """
+    anclas = {}
+    pendientes_mayusculas = list(_ANCLAS_MAYUSCULAS)
+    pendientes_tabla = list(_ANCLAS_TABLA)
+    for i, (word, upper) in enumerate(zip(words, uppers)):
+        for ancla in [ancla for ancla in pendientes_mayusculas if ancla in upper]:
+            anclas[ancla] = i
+            pendientes_mayusculas.remove(ancla)
+        for ancla in [ancla for ancla in pendientes_tabla if ancla in word]:
+            anclas[ancla] = i
+            pendientes_tabla.remove(ancla)
+        if not pendientes_mayusculas and not pendientes_tabla:
+            break
+    return anclas
+
+def _first_anchor(anclas, *palabras):
+    """
+    Devuelve el menor índice entre las palabras ancla encontradas, o None si no hay ninguna
+    """
+    indices = [anclas[palabra] for palabra in palabras if palabra in anclas]
+    return min(indices) if indices else None
+
+def _token_flags(patron, texto, inicios):
+    """
+    Marca los tokens en cuyo inicio coincide el patrón
+    
+    Args:
+        patron: Patrón compilado con '^' y re.MULTILINE
+        texto: Tokens unidos con saltos de línea
+        inicios: Mapa desplazamiento en texto -> índice de token
+        
+    Returns:
+        list: Un booleano por token
+    """
+    flags = [False] * len(inicios)
+    for match in patron.finditer(texto):
+        idx = inicios.get(match.start())
+        if idx is not None:
+            flags[idx] = True
+    return flags
+
 class FacturaExtractor:
     """Extrae información relevante de las facturas utilizando LayoutLM"""
     
@@ -19,12 +96,11 @@ class FacturaExtractor:
             model_name: Nombre del modelo LayoutLM a utilizar
         """
         logger.info(f"Inicializando extractor con modelo {model_name}")
-        # Cargar modelo para análisis espacial
-        self.model = LayoutLMv2ForTokenClassification.from_pretrained(model_name)
-        self.model.eval()
+        # El modelo se carga de forma diferida (ver la propiedad model)
+        self.model_name = model_name
         
         # Definir patrones comunes para facturas
-        self.patrones = {
+        patrones = {
             "invoice_number": [
                 r"(?:N°|N|N[úu]mero|No|Nº)\s*(?:de)?\s*(?:FACTURA|factura|Fra|fac)[\s:]*(\d+[/\-\.]*\d*)",
                 r"(?:FACTURA|factura|Fra|fac)[\s:]*(?:N°|N|N[úu]mero|No|Nº)[\s:]*(\d+[/\-\.]*\d*)",
@@ -49,6 +125,17 @@ class FacturaExtractor:
                 r"(?:LIQUIDO|liquido)[\s:]*(\d{1,3}(?:\.\d{3})*,\d{2})"
             ]
         }
+        # Compilar los patrones una sola vez para todas las facturas
+        self.patrones = {
+            campo: [re.compile(patron, re.IGNORECASE) for patron in lista]
+            for campo, lista in patrones.items()
+        }
+        # Cada campo también como una única alternancia: como cada patrón tiene exactamente
+        # un grupo de captura, el grupo i+1 corresponde a la alternativa i
+        self.patrones_combinados = {
+            campo: re.compile("|".join(f"(?:{patron})" for patron in lista), re.IGNORECASE)
+            for campo, lista in patrones.items()
+        }
         
         # Palabras clave por área funcional de la factura
         self.palabras_clave = {
@@ -59,7 +146,45 @@ class FacturaExtractor:
             "totales": ["TOTAL", "SUBTOTAL", "BASE", "I.V.A", "IVA", "IMPORTE", "LIQUIDO"],
             "pie": ["FORMA", "PAGO", "VENCIMIENTO", "OBSERVACIONES"]
         }
-        
+        # Todas las palabras clave en un único patrón, para localizar en una sola pasada
+        # cualquier palabra clave contenida en un token. El lookahead permite coincidencias
+        # solapadas, y las alternativas se ordenan por prioridad de área para que, si varias
+        # empiezan en la misma posición, gane la del área que se comprobaba primero
+        self._orden_area = {area: orden for orden, area in enumerate(self.palabras_clave)}
+        self._area_de_palabra = {}
+        for area, keywords in self.palabras_clave.items():
+            for keyword in keywords:
+                self._area_de_palabra.setdefault(keyword.upper(), area)
+        self._patron_palabras_clave = re.compile(
+            "(?=(" + "|".join(re.escape(keyword) for keyword in self._area_de_palabra) + "))"
+        )
+        self._all_keywords_upper = frozenset(self._area_de_palabra)
+        
+    @cached_property
+    def model(self):
+        """
+        Modelo LayoutLM para análisis espacial, cargado solo la primera vez que se usa
+        """
+        # torch y transformers se importan aquí: su carga es lenta y no hacen falta
+        # cuando los patrones resuelven todos los campos
+        import torch
+        from transformers import LayoutLMv2ForTokenClassification
+        
+        logger.info(f"Cargando modelo {self.model_name}")
+        model = LayoutLMv2ForTokenClassification.from_pretrained(self.model_name)
+        
+        # En GPU usar media precisión (bf16 si la tarjeta lo soporta, si no fp16);
+        # en CPU se mantiene fp32
+        if torch.cuda.is_available():
+            dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+            model = model.to(device="cuda", dtype=dtype)
+            logger.info(f"Modelo cargado en GPU con {dtype}")
+        
+        # Solo inferencia: sin dropout ni seguimiento de gradientes
+        model.eval()
+        model.requires_grad_(False)
+        return model
+    
     def extract_info(self, encoding, ocr_results):
         """
         Extrae información de la factura usando LayoutLM y análisis espacial
@@ -84,24 +209,34 @@ class FacturaExtractor:
         }
         
         # 1. Analizar el texto completo para poder hacer búsquedas generales
-        texto_completo = " ".join([word for word, _ in ocr_results])
+        # Palabras en una lista compartida (estructura de arrays junto con las cajas)
+        words = [word for word, _ in ocr_results]
+        uppers = [word.upper() for word in words]
+        texto_completo = " ".join(words)
         logger.info(f"Texto extraído: {texto_completo[:200]}...")
         
-        # 2. Organización espacial del documento
-        zonas_verticales = self._create_vertical_zones(ocr_results)
-        bloques_funcionales = self._identify_functional_blocks(ocr_results)
-        
-        # 3. Utilizar LayoutLM para entender contexto espacial
-        contextual_regions = self._analyze_spatial_context(encoding, ocr_results)
+        # Índice de la primera aparición de cada palabra ancla, calculado una sola vez
+        anclas = _find_anchors(words, uppers)
         
-        # 4. Extraer información basada en patrones y contexto
-        self._extract_invoice_number(invoice_data, ocr_results, zonas_verticales, bloques_funcionales)
-        self._extract_date(invoice_data, ocr_results, zonas_verticales, bloques_funcionales)
-        self._extract_client_info(invoice_data, ocr_results, zonas_verticales, bloques_funcionales)
-        self._extract_total(invoice_data, ocr_results, zonas_verticales, bloques_funcionales)
+        # 2. Organización espacial del documento
+        # Cajas en un array (N, 4) para operar sobre todas las posiciones a la vez
+        boxes = np.asarray([box for _, box in ocr_results], dtype=np.int64).reshape(-1, 4)
+        zonas_verticales = self._create_vertical_zones(boxes)
+        bloques_funcionales = self._identify_functional_blocks(ocr_results, uppers)
+        
+        # 3. Extraer información basada en patrones y contexto
+        self._extract_invoice_number(invoice_data, texto_completo, words, anclas, zonas_verticales, bloques_funcionales)
+        self._extract_date(invoice_data, texto_completo, words, anclas, zonas_verticales, bloques_funcionales)
+        self._extract_client_info(invoice_data, texto_completo, words, anclas, zonas_verticales, bloques_funcionales)
+        self._extract_total(invoice_data, texto_completo, words, anclas, zonas_verticales, bloques_funcionales)
+        
+        # 4. Utilizar LayoutLM para entender contexto espacial, solo si los patrones no
+        # han resuelto todos los campos obligatorios
+        if not all(invoice_data[campo] for campo in _CAMPOS_OBLIGATORIOS):
+            contextual_regions = self._analyze_spatial_context(encoding, ocr_results, boxes, uppers)
         
         # 5. Extraer líneas de detalle/items
-        invoice_data['items'] = self._extract_line_items(ocr_results, zonas_verticales, bloques_funcionales)
+        invoice_data['items'] = self._extract_line_items(ocr_results, anclas, zonas_verticales, bloques_funcionales)
         
         # 6. Logging detallado de los resultados
         for campo, valor in invoice_data.items():
@@ -112,39 +247,52 @@ class FacturaExtractor:
         
         return invoice_data
     
-    def _create_vertical_zones(self, ocr_results):
+    def extract_info_batch(self, encodings, ocr_results_list):
+        """
+        Extrae información de varias facturas con un único extractor
+        
+        Args:
+            encodings: Lista de datos codificados para LayoutLM, uno por factura
+            ocr_results_list: Lista de resultados del OCR, en el mismo orden
+        
+        Returns:
+            list: Información extraída de cada factura, en el mismo orden
+        """
+        if len(encodings) != len(ocr_results_list):
+            raise ValueError("encodings y ocr_results_list deben tener la misma longitud")
+        
+        logger.info(f"Extrayendo información de {len(encodings)} facturas")
+        return [
+            self.extract_info(encoding, ocr_results)
+            for encoding, ocr_results in zip(encodings, ocr_results_list)
+        ]
+    
+    def _create_vertical_zones(self, boxes):
         """
         Divide el documento en zonas verticales (superior, media, inferior)
         
         Args:
-            ocr_results: Lista de tuplas (palabra, caja) del OCR
+            boxes: Array (N, 4) con las cajas del OCR
             
         Returns:
-            dict: Mapa de zonas con índices y palabras
+            list: Un array con los índices de los tokens de cada zona, indexado por zona
         """
-        zones = defaultdict(list)
-        
         # Encontrar altura máxima
-        height_values = [box[3] for _, box in ocr_results]
-        max_height = max(height_values) if height_values else 1000
-        
-        # Dividir en 3 zonas verticales
-        zone_height = max_height / 3
+        max_height = int(boxes[:, 3].max()) if len(boxes) else 1000
         
-        for i, (word, box) in enumerate(ocr_results):
-            # Determinar zona vertical (0=superior, 1=medio, 2=inferior)
-            v_zone = int(box[1] / zone_height)
-            zones[v_zone].append((i, word, box))
+        # Determinar la zona vertical de todos los tokens a la vez (0=superior, 1=medio, 2=inferior)
+        zone_idx = boxes[:, 1] * _NUM_ZONAS // max(max_height, 1)
         
-        return zones
+        return [np.flatnonzero(zone_idx == zone) for zone in range(_NUM_ZONAS)]
     
-    def _identify_functional_blocks(self, ocr_results):
+    def _identify_functional_blocks(self, ocr_results, uppers):
         """
         Identifica bloques funcionales en la factura (cabecera, cliente, detalles, totales, pie)
         basado en palabras clave y posiciones
         
         Args:
             ocr_results: Lista de tuplas (palabra, caja) del OCR
+            uppers: Palabras del OCR en mayúsculas
             
         Returns:
             dict: Bloques funcionales con índices y palabras
@@ -159,13 +307,14 @@ class FacturaExtractor:
         
         # Asignar palabras a bloques basado en palabras clave
         for i, (word, box) in enumerate(ocr_results):
-            word_upper = word.upper()
+            word_upper = uppers[i]
             
-            # Buscar en todas las áreas
-            for area, keywords in self.palabras_clave.items():
-                if any(keyword in word_upper for keyword in keywords):
-                    bloques[area].append((i, word, box))
-                    break
+            # Buscar todas las palabras clave del token y quedarse con el área más prioritaria
+            areas = [self._area_de_palabra[match.group(1)]
+                     for match in self._patron_palabras_clave.finditer(word_upper)]
+            if areas:
+                area = min(areas, key=self._orden_area.__getitem__)
+                bloques[area].append((i, word, box))
         
         # Para palabras que no fueron asignadas, intentar inferir su bloque por posición
         if bloques["detalle"]:
@@ -176,35 +325,44 @@ class FacturaExtractor:
                 min_y = min(box[1] for box in detalle_boxes)
                 max_y = max(box[3] for box in detalle_boxes)
                 
+                # Índices ya asignados a algún bloque, para comprobar la pertenencia en O(1)
+                assigned = {i for items in bloques.values() for i, _, _ in items}
+                
                 # Asignar palabras que caen dentro de estos límites
                 for i, (word, box) in enumerate(ocr_results):
-                    if min_y <= box[1] <= max_y and not any((i, word, box) in items for items in bloques.values()):
+                    if min_y <= box[1] <= max_y and i not in assigned:
                         bloques["detalle"].append((i, word, box))
+                        assigned.add(i)
         
         return bloques
     
-    def _analyze_spatial_context(self, encoding, ocr_results):
+    def _analyze_spatial_context(self, encoding, ocr_results, boxes, uppers):
         """
         Analiza el contexto espacial utilizando LayoutLM
         
         Args:
             encoding: Encoding del modelo
             ocr_results: Lista de tuplas (palabra, caja) del OCR
+            boxes: Array (N, 4) con las cajas del OCR
+            uppers: Palabras del OCR en mayúsculas
             
         Returns:
             dict: Regiones contextuales
         """
-        # Crear grupos de palabras cercanas horizontalmente (misma línea)
-        horizontal_lines = defaultdict(list)
-        
-        for i, (word, box) in enumerate(ocr_results):
-            # Usar el centro vertical de la caja como clave de línea
-            line_key = (box[1] + box[3]) // 2
-            horizontal_lines[line_key].append((i, word, box))
-        
-        # Ordenar cada línea horizontal de izquierda a derecha
-        for line_key in horizontal_lines:
-            horizontal_lines[line_key].sort(key=lambda x: x[2][0])  # Ordenar por coordenada x
+        # Crear grupos de palabras cercanas horizontalmente (misma línea), usando como clave
+        # de línea el centro vertical de la caja redondeado a franjas de _LINE_BUCKET_PX, para
+        # que tokens de la misma línea con unos píxeles de deriva compartan clave. Una sola
+        # ordenación estable por (línea, x) agrupa las líneas de izquierda a derecha
+        line_keys = (boxes[:, 1] + boxes[:, 3]) // 2 // _LINE_BUCKET_PX * _LINE_BUCKET_PX
+        order = np.lexsort((boxes[:, 0], line_keys))
+        group_starts = np.flatnonzero(np.diff(line_keys[order])) + 1
+        
+        horizontal_lines = {}
+        for group in np.split(order, group_starts):
+            if len(group):
+                horizontal_lines[int(line_keys[group[0]])] = [
+                    (i, ocr_results[i][0], ocr_results[i][1]) for i in group.tolist()
+                ]
         
         # Identificar posibles etiquetas y valores (pares clave-valor)
         key_value_pairs = []
@@ -217,7 +375,7 @@ class FacturaExtractor:
                     idx2, word2, box2 = line_items[j + 1]
                     
                     # Si la primera palabra parece una etiqueta (termina en :, etc.)
-                    if re.search(r'[:.]$', word1) or word1.upper() in [w for keywords in self.palabras_clave.values() for w in keywords]:
+                    if word1.endswith((":", ".")) or uppers[idx1] in self._all_keywords_upper:
                         key_value_pairs.append({
                             "key": (idx1, word1, box1),
                             "value": (idx2, word2, box2)
@@ -228,163 +386,168 @@ class FacturaExtractor:
             "key_value_pairs": key_value_pairs
         }
     
-    def _extract_invoice_number(self, invoice_data, ocr_results, zonas, bloques):
+    def _search_field(self, campo, texto):
+        """
+        Busca un campo con la alternancia combinada de sus patrones en una sola pasada
+        
+        Se conserva la prioridad de la lista original: gana la primera aparición de la
+        alternativa más prioritaria, y la búsqueda se detiene al encontrar la primera.
+        En cada posición la alternancia devuelve la alternativa más prioritaria que coincide
+        allí, pero una coincidencia de menor prioridad puede contener el inicio de otra de
+        mayor prioridad, por lo que tras ella se sigue buscando desde la posición siguiente
+        a su inicio y no desde su final.
+        
+        Args:
+            campo: Nombre del campo en self.patrones_combinados
+            texto: Texto en el que buscar
+            
+        Returns:
+            str: Valor capturado, o None si ninguna alternativa coincide
+        """
+        patron = self.patrones_combinados[campo]
+        mejor = None
+        match = patron.search(texto)
+        while match:
+            if mejor is None or match.lastindex < mejor.lastindex:
+                mejor = match
+                if mejor.lastindex == 1:
+                    break
+            match = patron.search(texto, match.start() + 1)
+        return mejor.group(mejor.lastindex).strip() if mejor else None
+    
+    def _extract_invoice_number(self, invoice_data, texto_completo, words, anclas, zonas, bloques):
         """
         Extrae el número de factura
         """
         # Buscar directamente con patrones
-        texto_completo = " ".join([word for word, _ in ocr_results])
-        
-        for patron in self.patrones["invoice_number"]:
-            match = re.search(patron, texto_completo, re.IGNORECASE)
-            if match:
-                invoice_data["invoice_number"] = match.group(1).strip()
-                return
+        valor = self._search_field("invoice_number", texto_completo)
+        if valor is not None:
+            invoice_data["invoice_number"] = valor
+            return
         
         # Estrategia específica para Stipendium basado en el OCR analizado
         # Buscar cerca de "N° FACTURA" o palabras similares
-        factura_idx = None
-        for i, (word, _) in enumerate(ocr_results):
-            if "FACTURA" in word.upper():
-                factura_idx = i
-                break
+        factura_idx = anclas.get("FACTURA")
                 
         if factura_idx is not None:
             # Buscar números cercanos que podrían ser el número de factura
-            for i in range(max(0, factura_idx - 3), min(factura_idx + 5, len(ocr_results))):
-                word, _ = ocr_results[i]
+            for i in range(max(0, factura_idx - 3), min(factura_idx + 5, len(words))):
+                word = words[i]
                 # Verificar si parece un número de factura (formato ##/## como "24/62")
-                if re.match(r'\d{1,2}/\d{1,2}', word):
+                if _RE_INV_SHAPE.match(word):
                     invoice_data["invoice_number"] = word
                     return
                 # También buscar números simples
-                elif re.match(r'\d{2,6}', word) and word not in invoice_data.values():
+                elif _RE_INV_SIMPLE.match(word) and word not in invoice_data.values():
                     invoice_data["invoice_number"] = word
                     return
     
-    def _extract_date(self, invoice_data, ocr_results, zonas, bloques):
+    def _extract_date(self, invoice_data, texto_completo, words, anclas, zonas, bloques):
         """
         Extrae la fecha de la factura
         """
         # Buscar directamente con patrones
-        texto_completo = " ".join([word for word, _ in ocr_results])
-        
-        for patron in self.patrones["date"]:
-            match = re.search(patron, texto_completo, re.IGNORECASE)
-            if match:
-                invoice_data["date"] = match.group(1).strip()
-                return
+        valor = self._search_field("date", texto_completo)
+        if valor is not None:
+            invoice_data["date"] = valor
+            return
         
         # Estrategia específica para Stipendium basado en el OCR analizado
         # Buscar cerca de "FECHA" o palabras similares
-        fecha_idx = None
-        for i, (word, _) in enumerate(ocr_results):
-            if "FECHA" in word.upper():
-                fecha_idx = i
-                break
+        fecha_idx = anclas.get("FECHA")
                 
         if fecha_idx is not None:
             # Buscar formatos de fecha cercanos
-            for i in range(max(0, fecha_idx - 3), min(fecha_idx + 5, len(ocr_results))):
-                word, _ = ocr_results[i]
+            for i in range(max(0, fecha_idx - 3), min(fecha_idx + 5, len(words))):
+                word = words[i]
                 # Verificar si parece una fecha (formato DD/MM/YY como "01/01/24")
-                if re.match(r'\d{1,2}/\d{1,2}/\d{2,4}', word):
+                if _RE_DATE.match(word):
                     invoice_data["date"] = word
                     return
     
-    def _extract_client_info(self, invoice_data, ocr_results, zonas, bloques):
+    def _extract_client_info(self, invoice_data, texto_completo, words, anclas, zonas, bloques):
         """
         Extrae información del cliente (nombre y NIF/CIF)
         """
         # Buscar directamente con patrones para NIF/CIF
-        texto_completo = " ".join([word for word, _ in ocr_results])
-        
         # Extraer NIF/CIF
-        for patron in self.patrones["client_id"]:
-            match = re.search(patron, texto_completo, re.IGNORECASE)
-            if match:
-                invoice_data["client_id"] = match.group(1).strip()
-                break
+        valor = self._search_field("client_id", texto_completo)
+        if valor is not None:
+            invoice_data["client_id"] = valor
         
         # Estrategia específica para extraer nombre del cliente
         # En facturas de Stipendium, el cliente está en la zona superior
-        if 0 in zonas:  # Zona superior
+        if len(zonas[0]):  # Zona superior
             # Buscar patrones de nombre de cliente (empresas SL, SA)
-            for i, word, _ in zonas[0]:
+            for i in zonas[0].tolist():
+                word = words[i]
                 if "CAPITAL" in word or "PAN" in word or "SL" in word:
                     # Si encontramos varias palabras que parecen formar un nombre de empresa,
                     # intentamos reconstruir el nombre completo
-                    for j in range(i, min(i + 5, len(ocr_results))):
-                        if j < len(ocr_results) and "SL" in ocr_results[j][0]:
+                    for j in range(i, min(i + 5, len(words))):
+                        if j < len(words) and "SL" in words[j]:
                             # Construir el nombre del cliente desde i hasta j
-                            cliente_parts = [ocr_results[k][0] for k in range(i, j + 1)]
+                            cliente_parts = words[i:j + 1]
                             invoice_data["client_name"] = " ".join(cliente_parts)
                             return
         
         # Si no encontramos nombre de cliente, buscar cerca de "CLIENTE" como respaldo
-        cliente_idx = None
-        for i, (word, _) in enumerate(ocr_results):
-            if "CLIENTE" in word.upper():
-                cliente_idx = i
-                break
+        cliente_idx = anclas.get("CLIENTE")
                 
         if cliente_idx is not None:
             # Buscar texto cercano que podría ser el nombre del cliente
-            for i in range(cliente_idx + 1, min(cliente_idx + 5, len(ocr_results))):
-                word, _ = ocr_results[i]
+            for i in range(cliente_idx + 1, min(cliente_idx + 5, len(words))):
+                word = words[i]
                 if len(word) > 2 and not word.isdigit():
                     invoice_data["client_name"] = word
                     break
     
-    def _extract_total(self, invoice_data, ocr_results, zonas, bloques):
+    def _extract_total(self, invoice_data, texto_completo, words, anclas, zonas, bloques):
         """
         Extrae el importe total de la factura
         """
         # Buscar directamente con patrones
-        texto_completo = " ".join([word for word, _ in ocr_results])
-        
-        for patron in self.patrones["total"]:
-            match = re.search(patron, texto_completo, re.IGNORECASE)
-            if match:
-                invoice_data["total"] = match.group(1).strip()
-                return
+        valor = self._search_field("total", texto_completo)
+        if valor is not None:
+            invoice_data["total"] = valor
+            return
         
         # Estrategia específica para Stipendium basado en el OCR analizado
         # Buscar cerca de "IMPORTE LIQUIDO" o palabras similares
-        total_idx = None
-        for i, (word, _) in enumerate(ocr_results):
-            if "LIQUIDO" in word.upper() or "TOTAL" in word.upper():
-                total_idx = i
-                break
+        total_idx = _first_anchor(anclas, "LIQUIDO", "TOTAL")
                 
         if total_idx is not None:
             # Buscar importes cercanos (números con formato de dinero)
-            for i in range(max(0, total_idx - 3), min(total_idx + 8, len(ocr_results))):
-                word, _ = ocr_results[i]
+            for i in range(max(0, total_idx - 3), min(total_idx + 8, len(words))):
+                word = words[i]
                 # Verificar si parece un importe (formato ###,## como "267,17")
-                if re.match(r'\d{1,3}(?:\.\d{3})*,\d{2}', word):
+                if _RE_AMOUNT.match(word):
                     invoice_data["total"] = word
                     return
         
         # Buscar en zona inferior donde suelen estar los totales
-        if 2 in zonas:  # Zona inferior
+        if len(zonas[2]):  # Zona inferior
             # Buscar importes que parecen totales
-            importes = []
-            for _, word, _ in zonas[2]:
-                if re.match(r'\d{1,3}(?:\.\d{3})*,\d{2}', word):
-                    importes.append(word)
+            zone_words = [words[i] for i in zonas[2].tolist()]
+            importes = [word for word in zone_words if _RE_AMOUNT.match(word)]
             
             if importes:
-                # Normalmente el último importe o el más grande es el total
-                max_importe = max(importes, key=lambda x: float(x.replace(".", "").replace(",", ".")))
-                invoice_data["total"] = max_importe
+                # Normalmente el último importe o el más grande es el total: convertir todos
+                # los importes a un array de floats y quedarse con el primero de valor máximo
+                valores = np.fromiter(
+                    (float(x.replace(".", "").replace(",", ".")) for x in importes),
+                    dtype=np.float64,
+                    count=len(importes)
+                )
+                invoice_data["total"] = importes[int(valores.argmax())]
     
-    def _extract_line_items(self, ocr_results, zonas, bloques):
+    def _extract_line_items(self, ocr_results, anclas, zonas, bloques):
         """
         Extrae las líneas de detalle (conceptos, importes)
         
         Args:
             ocr_results: Lista de tuplas (palabra, caja) del OCR
+            anclas: Índice de la primera aparición de cada palabra ancla
             zonas: Zonas verticales del documento
             bloques: Bloques funcionales identificados
             
@@ -393,18 +556,25 @@ class FacturaExtractor:
         """
         items = []
         
+        # Clasificar todos los tokens de una vez (importe, código, decimal) con un recorrido
+        # de cada patrón sobre el texto unido, en lugar de aplicar re.match token a token
+        texto_lineas = "\n".join(word for word, _ in ocr_results)
+        inicios = {}
+        offset = 0
+        for i, (word, _) in enumerate(ocr_results):
+            inicios[offset] = i
+            offset += len(word) + 1
+        es_importe = _token_flags(_RE_AMOUNT_TOKENS, texto_lineas, inicios)
+        es_codigo = _token_flags(_RE_CODE_TOKENS, texto_lineas, inicios)
+        es_decimal = _token_flags(_RE_DEC_TOKENS, texto_lineas, inicios)
+        
         # Identificar la región de detalles/conceptos
         zona_detalles = 1  # Por defecto, zona media
         
         # Buscar palabras clave que indican la tabla de detalles
-        tabla_inicio_idx = None
+        tabla_inicio_idx = _first_anchor(anclas, *_ANCLAS_TABLA)
         tabla_fin_idx = None
         
-        for i, (word, _) in enumerate(ocr_results):
-            if "__DESCRIPCION" in word or "CONCEPTO" in word or "CARGOS" in word:
-                tabla_inicio_idx = i
-                break
-        
         # Si encontramos el inicio de la tabla
         if tabla_inicio_idx is not None:
             # Buscar el índice donde termina la tabla de detalles
@@ -426,7 +596,7 @@ class FacturaExtractor:
                 word, box = ocr_results[i]
                 
                 # Si parece un código o inicio de línea
-                if re.match(r'[A-Za-z0-9]{3,8}', word) or "Cuota" in word:
+                if es_codigo[i] or "Cuota" in word:
                     descripcion_parts = []
                     descripcion_parts.append(word)
                     
@@ -438,7 +608,7 @@ class FacturaExtractor:
                         next_word, next_box = ocr_results[j]
                         
                         # Si parece un importe, terminar la línea
-                        if re.match(r'\d{1,3}(?:\.\d{3})*,\d{2}', next_word):
+                        if es_importe[j]:
                             importe = next_word
                             break
                         
@@ -466,9 +636,14 @@ class FacturaExtractor:
                     
         # Si no encontramos ítems con el método anterior, intentar método alternativo
         if not items:
-            # Buscar todos los importes en formato ###,## y sus contextos
-            for i, (word, box) in enumerate(ocr_results):
-                if re.match(r'\d{1,3}(?:\.\d{3})*,\d{2}', word) and "TOTAL" not in ocr_results[max(0, i-1)][0]:
+            # Importes ya añadidos, para comprobar duplicados en O(1)
+            importes_vistos = set()
+            
+            # Buscar todos los importes en formato ###,## y sus contextos, recorriendo
+            # solo los tokens ya clasificados como importe
+            for i in [i for i, flag in enumerate(es_importe) if flag]:
+                word = ocr_results[i][0]
+                if "TOTAL" not in ocr_results[max(0, i-1)][0]:
                     # Buscar hacia atrás para encontrar una descripción
                     descripcion = "Servicio"  # Por defecto
                     
@@ -478,7 +653,7 @@ class FacturaExtractor:
                         
                         # Si es una palabra larga o contiene palabras clave
                         if (len(prev_word) > 4 and 
-                            not re.match(r'\d+[.,]\d{2}', prev_word) and
+                            not es_decimal[j] and
                             "TOTAL" not in prev_word and
                             "IVA" not in prev_word and
                             "BASE" not in prev_word):
@@ -490,7 +665,7 @@ class FacturaExtractor:
                                 more_words = []
                                 for k in range(j-1, max(0, j-5), -1):
                                     if (abs(ocr_results[k][1][1] - prev_box[1]) < 20 and
-                                        not re.match(r'\d+[.,]\d{2}', ocr_results[k][0])):
+                                        not es_decimal[k]):
                                         more_words.insert(0, ocr_results[k][0])
                                 
                                 if more_words:
@@ -499,7 +674,8 @@ class FacturaExtractor:
                             break
                     
                     # No duplicar ítems que ya existen
-                    if not any(item["amount"] == word for item in items):
+                    if word not in importes_vistos:
+                        importes_vistos.add(word)
                         items.append({
                             "description": descripcion,
                             "amount": word
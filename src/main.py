@@ -5,19 +5,39 @@ from processor import DocumentProcessor
 from extractor import FacturaExtractor
 from excel_writer import ExcelWriter
 import time
-import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def process_invoice(file_path, output_dir=None, save_ocr=False):
+# Extensiones de archivo de factura admitidas (se comparan en minúsculas)
+_PDF_EXTENSIONS = {".pdf"}
+_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".tiff"}
+
+# Componentes propios de cada proceso trabajador (se crean una vez por proceso)
+_worker_processor = None
+_worker_extractor = None
+
+def _init_worker():
+    """Inicializa el procesador y el extractor de un proceso trabajador"""
+    global _worker_processor, _worker_extractor
+    _worker_processor = DocumentProcessor()
+    _worker_extractor = FacturaExtractor()
+
+def _process_invoice_worker(file_path, output_dir, save_ocr):
+    """Procesa una factura dentro de un proceso trabajador reutilizando sus componentes"""
+    return process_invoice(file_path, output_dir, save_ocr, _worker_processor, _worker_extractor)
+
+def process_invoice(file_path, output_dir=None, save_ocr=False, processor=None, extractor=None):
     """
     Procesa una factura y extrae su información
     
     Args:
         file_path: Ruta al archivo de factura (PDF o imagen)
         output_dir: Directorio para guardar la salida (opcional)
-        save_ocr: Si es True, guarda los resultados del OCR en un archivo .txt
+        save_ocr: Si es True, guarda los resultados del OCR en un archivo .npz
+        processor: DocumentProcessor ya inicializado para reutilizar (opcional)
+        extractor: FacturaExtractor ya inicializado para reutilizar (opcional)
         
     Returns:
         dict: Datos extraídos de la factura
@@ -26,8 +46,8 @@ def process_invoice(file_path, output_dir=None, save_ocr=False):
     start_time = time.time()
     logger.info(f"Iniciando procesamiento de {file_path}")
     
-    processor = DocumentProcessor()
-    extractor = FacturaExtractor()
+    processor = processor or DocumentProcessor()
+    extractor = extractor or FacturaExtractor()
     
     # Procesar documento
     encoding, ocr_results, image = processor.process_document(file_path, save_ocr)
@@ -84,26 +104,34 @@ def generate_single_invoice_excel(invoice_data, file_path, output_dir=None):
     
     return output_file
 
-def process_multiple_invoices(directory_path, output_dir=None, save_ocr=False):
+def process_multiple_invoices(directory_path, output_dir=None, save_ocr=False, max_workers=None):
     """
     Procesa múltiples facturas y genera un archivo Excel consolidado
     
     Args:
         directory_path: Directorio con los archivos de factura
         output_dir: Directorio para guardar la salida (opcional)
-        save_ocr: Si es True, guarda los resultados del OCR en un archivo .txt
+        save_ocr: Si es True, guarda los resultados del OCR en un archivo .npz
+        max_workers: Número de procesos en paralelo (por defecto, una cuarta parte de las
+            CPUs, ya que cada proceso tiene su propio Tesseract, que ya usa varios núcleos;
+            1 procesa en serie, recomendado si el modelo se ejecuta en una única GPU)
         
     Returns:
         str: Ruta al archivo Excel generado
     """
-    # Buscar archivos de factura en el directorio (PDF e imágenes)
+    # Buscar archivos de factura en el directorio (PDF e imágenes) con un único recorrido
     pdf_files = []
-    pdf_files.extend(glob.glob(os.path.join(directory_path, "*.pdf")))
-    pdf_files.extend(glob.glob(os.path.join(directory_path, "*.PDF")))
-    
     image_files = []
-    for ext in ["jpg", "jpeg", "png", "tiff", "JPG", "JPEG", "PNG", "TIFF"]:
-        image_files.extend(glob.glob(os.path.join(directory_path, f"*.{ext}")))
+    with os.scandir(directory_path) as entries:
+        for entry in entries:
+            # Igual que glob, ignorar archivos ocultos
+            if entry.name.startswith("."):
+                continue
+            ext = os.path.splitext(entry.name)[1].lower()
+            if ext in _PDF_EXTENSIONS and entry.is_file():
+                pdf_files.append(entry.path)
+            elif ext in _IMAGE_EXTENSIONS and entry.is_file():
+                image_files.append(entry.path)
     
     invoice_files = pdf_files + image_files
     
@@ -113,33 +141,80 @@ def process_multiple_invoices(directory_path, output_dir=None, save_ocr=False):
     
     logger.info(f"Se encontraron {len(invoice_files)} facturas para procesar")
     
+    max_workers = min(max_workers or max(1, (os.cpu_count() or 1) // 4), len(invoice_files))
+    
+    # Generar nombre para el Excel consolidado
+    timestamp = time.strftime("%Y%m%d_%H%M%S")
+    folder_name = os.path.basename(os.path.normpath(directory_path))
+    
+    if output_dir:
+        excel_path = os.path.join(output_dir, f"facturas_{folder_name}_{timestamp}.xlsx")
+    else:
+        excel_path = f"facturas_{folder_name}_{timestamp}.xlsx"
+    
+    # El Excel consolidado se abre con la primera factura procesada y cada factura se
+    # escribe en cuanto está disponible, sin acumular todas las facturas en memoria
+    writer = ExcelWriter()
+    written = 0
+    
+    def write_invoice(invoice_data):
+        nonlocal written
+        if written == 0:
+            writer.open(excel_path)
+        writer.append_invoice(invoice_data)
+        written += 1
+    
     # Procesar cada factura
-    all_invoice_data = []
-    for file_path in invoice_files:
-        try:
-            logger.info(f"Procesando {os.path.basename(file_path)}")
-            invoice_data = process_invoice(file_path, output_dir, save_ocr)
-            all_invoice_data.append(invoice_data)
-        except Exception as e:
-            logger.error(f"Error procesando {os.path.basename(file_path)}: {e}", exc_info=True)
-    
-    # Generar Excel consolidado
-    if all_invoice_data:
-        writer = ExcelWriter()
-        
-        # Generar nombre para el Excel consolidado
-        timestamp = time.strftime("%Y%m%d_%H%M%S")
-        folder_name = os.path.basename(os.path.normpath(directory_path))
-        
-        if output_dir:
-            excel_path = os.path.join(output_dir, f"facturas_{folder_name}_{timestamp}.xlsx")
+    try:
+        if max_workers <= 1:
+            # Inicializar los componentes una sola vez para todas las facturas
+            processor = DocumentProcessor()
+            extractor = FacturaExtractor()
+            
+            for file_path in invoice_files:
+                try:
+                    logger.info(f"Procesando {os.path.basename(file_path)}")
+                    invoice_data = process_invoice(file_path, output_dir, save_ocr, processor, extractor)
+                except Exception as e:
+                    logger.error(f"Error procesando {os.path.basename(file_path)}: {e}", exc_info=True)
+                    continue
+                write_invoice(invoice_data)
         else:
-            excel_path = f"facturas_{folder_name}_{timestamp}.xlsx"
-        
-        # Escribir todas las facturas en un único Excel
-        output_file = writer.write_multiple_invoices(all_invoice_data, excel_path)
+            logger.info(f"Procesando en paralelo con {max_workers} procesos")
+            # Resultados terminados pendientes de escribir, por posición del archivo; se
+            # escriben en el orden original en cuanto están disponibles todos los anteriores
+            pending = {}
+            next_idx = 0
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker) as executor:
+                futures = {
+                    executor.submit(_process_invoice_worker, file_path, output_dir, save_ocr): idx
+                    for idx, file_path in enumerate(invoice_files)
+                }
+                try:
+                    for future in as_completed(futures):
+                        idx = futures[future]
+                        try:
+                            pending[idx] = future.result()
+                        except Exception as e:
+                            pending[idx] = None
+                            logger.error(f"Error procesando {os.path.basename(invoice_files[idx])}: {e}", exc_info=True)
+                        
+                        while next_idx in pending:
+                            invoice_data = pending.pop(next_idx)
+                            next_idx += 1
+                            if invoice_data is not None:
+                                write_invoice(invoice_data)
+                except BaseException:
+                    # Si falla la escritura (o se interrumpe), cancelar las facturas aún no
+                    # iniciadas para que el error no espere a procesar todo el directorio
+                    for future in futures:
+                        future.cancel()
+                    raise
+    finally:
+        output_file = writer.close() if written else None
+    
+    if output_file:
         logger.info(f"Excel consolidado generado: {output_file}")
-        
         return output_file
     else:
         logger.warning("No se pudo generar Excel consolidado: no hay datos de facturas")
@@ -154,7 +229,9 @@ def main():
     
     parser.add_argument('--output', '-o', help='Directorio de salida para el Excel')
     parser.add_argument('--debug', action='store_true', help='Habilita modo debug con más información')
-    parser.add_argument('--save-ocr', action='store_true', help='Guarda los resultados del OCR en archivos de texto')
+    parser.add_argument('--save-ocr', action='store_true', help='Guarda los resultados del OCR en archivos .npz (palabras y cajas)')
+    parser.add_argument('--max-workers', '-w', type=int, default=None,
+                        help='Procesos en paralelo para --directory (por defecto, una cuarta parte de las CPUs; use 1 con GPU)')
     
     args = parser.parse_args()
     
@@ -175,7 +252,7 @@ def main():
             print(f"✅ Factura procesada exitosamente. Excel guardado en: {excel_file}")
         elif args.directory:
             # Procesar múltiples facturas
-            excel_file = process_multiple_invoices(args.directory, args.output, args.save_ocr)
+            excel_file = process_multiple_invoices(args.directory, args.output, args.save_ocr, args.max_workers)
             if excel_file:
                 print(f"✅ Facturas procesadas exitosamente. Excel consolidado guardado en: {excel_file}")
             else:
@@ -1,66 +1,332 @@
 import os
-import pytesseract
-from pdf2image import convert_from_path
-from PIL import Image
+import queue
+import hashlib
+import pickle
+import tesserocr
+import pymupdf
+from PIL import Image, ImageOps
 import torch
 from transformers import LayoutLMv2Processor
 import logging
 import json
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import cached_property, lru_cache
+from itertools import islice
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Lado de la imagen cuadrada que recibe la rama visual de LayoutLMv2
+_IMAGE_SIZE = 224
+
+# Resolución a la que se rasterizan las páginas PDF: suficiente para el OCR, y la imagen
+# acaba reducida a _IMAGE_SIZE para el modelo
+_PDF_DPI = 150
+
+# Lado mayor máximo de las imágenes que se pasan al OCR; las más grandes se reducen
+# conservando la proporción (un OCR sobre imágenes enormes es más lento sin ganar precisión)
+_MAX_OCR_SIDE = 2000
+
+# Idioma y modo de segmentación de página de las instancias de Tesseract
+_TESS_LANG = "eng"
+_TESS_PSM = tesserocr.PSM.AUTO
+
+@lru_cache(maxsize=4)
+def _load_processor(processor_name):
+    """
+    Carga un procesador LayoutLM una sola vez por proceso y nombre, de modo que todas las
+    instancias de DocumentProcessor lo comparten
+    
+    Args:
+        processor_name: Nombre del procesador LayoutLM a cargar
+        
+    Returns:
+        LayoutLMv2Processor: Procesador con apply_ocr=False y tokenizador rápido (Rust)
+    """
+    logger.info(f"Cargando procesador {processor_name}")
+    # Inicializar el procesador con apply_ocr=False para evitar conflictos
+    return LayoutLMv2Processor.from_pretrained(processor_name, apply_ocr=False, use_fast=True)
+
+@dataclass(eq=False)
+class LazyOCRResult:
+    """
+    Resultado de procesar la primera página de un documento, calculado por partes solo
+    cuando se accede a ellas: la imagen se carga al pedir image, el OCR se ejecuta al pedir
+    ocr_results y la codificación para LayoutLM al pedir encoding. Cada parte se calcula
+    una sola vez; tras usar la imagen, `del result.image` libera su memoria
+    """
+    processor: "DocumentProcessor"
+    file_path: str
+    save_ocr: bool = False
+    
+    @cached_property
+    def image(self):
+        """Imagen PIL de la primera página"""
+        return list(self.processor._iter_pages(self.file_path, all_pages=False))[0]
+    
+    @cached_property
+    def ocr_results(self):
+        """Palabras detectadas con sus posiciones"""
+        # La imagen solo se carga si el OCR no está en la caché
+        ocr_results = self.processor._perform_ocr_cached(self.file_path, lambda: self.image)
+        if self.save_ocr:
+            self.processor._save_page_ocr(self.file_path, 1, ocr_results)
+        return ocr_results
+    
+    @cached_property
+    def encoding(self):
+        """Entradas procesadas para el modelo"""
+        return self.processor._prepare_for_layoutlm(self.image, self.ocr_results)
+
 class DocumentProcessor:
     """Procesa documentos PDF/imágenes para preparar entrada al modelo LayoutLM"""
     
-    def __init__(self, processor_name="microsoft/layoutlmv2-base-uncased"):
+    def __init__(self, processor_name="microsoft/layoutlmv2-base-uncased", ocr_workers=None,
+                 max_length=512, ocr_human_readable=False, compile_friendly_shapes=False,
+                 min_conf=50, cache_dir=None):
         """
         Inicializa el procesador de documentos
         
         Args:
             processor_name: Nombre del procesador LayoutLM a utilizar
+            ocr_workers: Hilos para aplicar OCR a varias páginas a la vez (por defecto, una
+                cuarta parte de las CPUs: cada Tesseract ya usa varios núcleos)
+            max_length: Número máximo de tokens por documento; las secuencias más largas se
+                truncan. Las más cortas ya no se rellenan hasta esta longitud, por lo que la
+                forma de las entradas depende de cada documento
+            ocr_human_readable: Si es True, los resultados del OCR se guardan como texto y
+                JSON (.txt) en lugar de en formato binario comprimido (.npz)
+            compile_friendly_shapes: Si es True, todas las secuencias se rellenan hasta
+                max_length, de modo que las entradas tienen siempre la misma forma y un modelo
+                envuelto con torch.compile(model, mode="reduce-overhead") no se recompila
+                con cada documento. A cambio se pierde el ahorro del relleno dinámico: la
+                atención se calcula sobre max_length posiciones aunque el texto sea corto
+            min_conf: Confianza mínima del OCR (0-100) para conservar una palabra; las de
+                menor confianza suelen ser ruido y ocupan posiciones de atención del modelo
+            cache_dir: Directorio opcional donde guardar los resultados del OCR de cada
+                documento, identificados por el hash SHA-256 de su contenido; al volver a
+                procesar el mismo archivo (aunque cambie de nombre) se evita repetir el OCR
         """
         logger.info(f"Inicializando procesador con {processor_name}")
-        # Inicializar el procesador con apply_ocr=False para evitar conflictos
-        self.processor = LayoutLMv2Processor.from_pretrained(processor_name, apply_ocr=False)
+        self.processor = _load_processor(processor_name)
+        self.ocr_workers = ocr_workers or max(1, (os.cpu_count() or 1) // 4)
+        self.min_conf = min_conf
+        # Instancias de Tesseract (en proceso) disponibles para reutilizar. Cada instancia
+        # solo puede reconocer una imagen a la vez, así que cada hilo de OCR toma una libre
+        # y la devuelve al terminar; se crean más solo si hay varias páginas en paralelo.
+        # Los datos de idioma se cargan una vez por instancia y se liberan con close()
+        self._tess_apis = []
+        self._tess_pool = queue.SimpleQueue()
+        self._tess_pool.put(self._create_tess_api())
+        self.max_length = max_length
+        # Relleno dinámico (hasta la secuencia más larga) salvo que se pidan formas fijas;
+        # la imagen ya tiene siempre el mismo tamaño (_IMAGE_SIZE)
+        self.padding = "max_length" if compile_friendly_shapes else True
+        self.ocr_human_readable = ocr_human_readable
+        self.cache_dir = cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        # Dispositivo al que to_device envía las entradas del modelo
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        if self.device.type == "cuda":
+            # La imagen de entrada a la rama visual (convolucional) tiene siempre el mismo
+            # tamaño, así que compensa que cuDNN elija el algoritmo más rápido una vez
+            torch.backends.cudnn.benchmark = True
+        
+        # Llamada de calentamiento con una imagen en blanco y unas pocas palabras, para que
+        # el primer documento real no pague la inicialización perezosa del tokenizador
+        self._prepare_for_layoutlm(
+            Image.new("RGB", (_IMAGE_SIZE, _IMAGE_SIZE), "white"),
+            [("warmup", [0, 0, 1, 1])] * 8
+        )
         
+    def __enter__(self):
+        """
+        Permite usar el procesador en un bloque with, que libera Tesseract al salir
+        """
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Libera las instancias de Tesseract al salir del bloque with
+        """
+        self.close()
+        return False
+    
+    def close(self):
+        """
+        Libera las instancias de Tesseract y la memoria de Leptonica asociada. Si después
+        se procesa otro documento, se crea una instancia nueva
+        """
+        for api in self._tess_apis:
+            api.End()
+        logger.info(f"Liberadas {len(self._tess_apis)} instancias de Tesseract")
+        self._tess_apis = []
+        self._tess_pool = queue.SimpleQueue()
+    
     def process_document(self, file_path, save_ocr=False):
         """
         Procesa un documento (PDF o imagen) y lo prepara para LayoutLM
         
         Args:
             file_path: Ruta al archivo a procesar
-            save_ocr: Si es True, guarda los resultados del OCR en un archivo .txt
+            save_ocr: Si es True, guarda los resultados del OCR en un archivo (.npz, o .txt
+                si ocr_human_readable es True)
             
         Returns:
             dict: Entradas procesadas para el modelo
             list: Lista de palabras detectadas con sus posiciones
             PIL.Image: Imagen procesada
         """
-        logger.info(f"Procesando documento: {file_path}")
+        # Con caché, el OCR de la primera página se busca antes en disco
+        if self.cache_dir:
+            result = self.process_document_lazy(file_path, save_ocr)
+            return result.encoding, result.ocr_results, result.image
         
-        # Convertir PDF a imagen si es necesario
-        if file_path.lower().endswith('.pdf'):
-            logger.info("Convirtiendo PDF a imagen")
-            images = convert_from_path(file_path)
-            image = images[0]  # Procesamos solo la primera página por simplicidad
-        else:
-            image = Image.open(file_path)
+        # Solo se procesa la primera página de los PDF
+        return self.process_documents([file_path], save_ocr, all_pages=False)[0]
+    
+    def process_documents(self, file_paths, save_ocr=False, all_pages=True):
+        """
+        Procesa varios documentos (PDF o imágenes), incluyendo todas las páginas de los PDF,
+        y los prepara para LayoutLM
+        
+        La lista devuelta conserva la imagen de cada página, así que la memoria crece con el
+        número total de páginas; para procesar muchas páginas sin acumularlas, usar
+        iter_documents
+        
+        Args:
+            file_paths: Rutas a los archivos a procesar
+            save_ocr: Si es True, guarda los resultados del OCR de cada página en un archivo
+            all_pages: Si es False, de cada PDF solo se procesa la primera página
+            
+        Returns:
+            list: Una tupla (encoding, ocr_results, image) por página, en el orden de los
+            archivos y de sus páginas
+        """
+        return list(self.iter_documents(file_paths, save_ocr, all_pages))
+    
+    def iter_documents(self, file_paths, save_ocr=False, all_pages=True):
+        """
+        Procesa varios documentos como process_documents, pero devolviendo las páginas a
+        medida que se procesan. Las páginas se rasterizan por tandas de ocr_workers, de modo
+        que solo las imágenes de la tanda en curso (y las que conserve quien llama) están en
+        memoria a la vez
         
-        # Aplicar OCR para obtener palabras y sus posiciones
-        ocr_results = self._perform_ocr(image)
+        Args:
+            file_paths: Rutas a los archivos a procesar
+            save_ocr: Si es True, guarda los resultados del OCR de cada página en un archivo
+            all_pages: Si es False, de cada PDF solo se procesa la primera página
+            
+        Yields:
+            tuple: (encoding, ocr_results, image) por página, en el orden de los archivos
+            y de sus páginas
+        """
+        pages = self._iter_all_pages(file_paths, all_pages)
+        
+        # Tesseract libera el GIL, así que las páginas de cada tanda se reconocen en
+        # paralelo con hilos; map conserva el orden de las páginas
+        executor = ThreadPoolExecutor(max_workers=self.ocr_workers) if self.ocr_workers > 1 else None
+        try:
+            while True:
+                window = list(islice(pages, self.ocr_workers))
+                if not window:
+                    break
+                
+                # Aplicar OCR a las páginas de la tanda para obtener palabras y sus posiciones
+                images = [image for _, _, image in window]
+                if executor and len(images) > 1:
+                    ocr_pages = list(executor.map(self._perform_ocr, images))
+                else:
+                    ocr_pages = [self._perform_ocr(image) for image in images]
+                
+                for (file_path, page_num, image), ocr_results in zip(window, ocr_pages):
+                    # Guardar resultados del OCR solo si se solicita
+                    if save_ocr:
+                        self._save_page_ocr(file_path, page_num, ocr_results)
+                    
+                    # Procesar para LayoutLM
+                    encoding = self._prepare_for_layoutlm(image, ocr_results)
+                    yield encoding, ocr_results, image
+        finally:
+            if executor:
+                executor.shutdown()
+    
+    def _iter_all_pages(self, file_paths, all_pages):
+        """
+        Genera las páginas de varios documentos, rasterizando cada una solo cuando se pide
         
-        # Guardar resultados del OCR en archivo de texto solo si se solicita
-        if save_ocr:
-            base_name = os.path.splitext(os.path.basename(file_path))[0]
-            ocr_output_path = f"{base_name}_ocr_output.txt"
-            self._save_ocr_results(ocr_results, ocr_output_path)
-            logger.info(f"Resultados del OCR guardados en {ocr_output_path}")
+        Yields:
+            tuple: (file_path, page_num, image), con page_num desde 1
+        """
+        for file_path in file_paths:
+            logger.info(f"Procesando documento: {file_path}")
+            for page_num, image in enumerate(self._iter_pages(file_path, all_pages), 1):
+                yield file_path, page_num, image
+    
+    def process_document_lazy(self, file_path, save_ocr=False):
+        """
+        Prepara el procesamiento de la primera página de un documento sin ejecutarlo: la
+        imagen, el OCR y la codificación se calculan al acceder a ellos
+        
+        Args:
+            file_path: Ruta al archivo a procesar
+            save_ocr: Si es True, guarda los resultados del OCR cuando se calculen
+            
+        Returns:
+            LazyOCRResult: Resultado con image, ocr_results y encoding diferidos
+        """
+        logger.info(f"Procesando documento (diferido): {file_path}")
+        return LazyOCRResult(self, file_path, save_ocr)
+    
+    def _save_page_ocr(self, file_path, page_num, ocr_results):
+        """
+        Guarda los resultados del OCR de una página junto al nombre del documento
         
-        # Procesar para LayoutLM
-        encoding = self._prepare_for_layoutlm(image, ocr_results)
+        Args:
+            file_path: Ruta al documento original
+            page_num: Número de página (desde 1); las páginas siguientes a la primera
+                añaden el sufijo _pagN
+            ocr_results: Resultados del OCR de la página
+        """
+        base_name = os.path.splitext(os.path.basename(file_path))[0]
+        suffix = f"_pag{page_num}" if page_num > 1 else ""
+        ext = ".txt" if self.ocr_human_readable else ".npz"
+        ocr_output_path = f"{base_name}{suffix}_ocr_output{ext}"
+        self._save_ocr_results(ocr_results, ocr_output_path, self.ocr_human_readable)
+        logger.info(f"Resultados del OCR guardados en {ocr_output_path}")
+    
+    def _iter_pages(self, file_path, all_pages=True):
+        """
+        Genera las páginas de un documento como imágenes, rasterizando cada página de un PDF
+        solo cuando se solicita
         
-        return encoding, ocr_results, image
+        Args:
+            file_path: Ruta al archivo (PDF o imagen)
+            all_pages: Si es False, de un PDF solo se convierte la primera página
+            
+        Yields:
+            PIL.Image: Imagen de cada página
+        """
+        # Convertir PDF a imagen si es necesario
+        if file_path.lower().endswith('.pdf'):
+            logger.info("Convirtiendo PDF a imagen")
+            with pymupdf.open(file_path) as doc:
+                for page_num in range(doc.page_count if all_pages else min(1, doc.page_count)):
+                    pix = doc[page_num].get_pixmap(dpi=_PDF_DPI)
+                    yield self._limit_size(Image.frombytes("RGB", (pix.width, pix.height), pix.samples))
+        else:
+            yield self._limit_size(Image.open(file_path))
+    
+    def _limit_size(self, image):
+        """
+        Reduce la imagen si su lado mayor supera _MAX_OCR_SIDE, conservando la proporción
+        (las imágenes más pequeñas se devuelven sin cambios)
+        """
+        if max(image.size) > _MAX_OCR_SIDE:
+            return ImageOps.contain(image, (_MAX_OCR_SIDE, _MAX_OCR_SIDE))
+        return image
         
     def _perform_ocr(self, image):
         """
@@ -73,33 +339,126 @@ class DocumentProcessor:
             list: Resultados de OCR con palabra y posición
         """
         logger.info("Aplicando OCR a la imagen")
-        # Obtener resultados completos del OCR
-        ocr_df = pytesseract.image_to_data(image, output_type=pytesseract.Output.DATAFRAME)
+        try:
+            api = self._tess_pool.get_nowait()
+        except queue.Empty:
+            api = self._create_tess_api()
         
-        # Filtrar solo filas con texto
-        ocr_df = ocr_df[ocr_df.conf > 0]
-        
-        # Crear lista de resultados OCR con formato esperado por LayoutLM
+        # Reconocer la imagen directamente en memoria, sin escribirla a disco ni lanzar
+        # un proceso de Tesseract por cada imagen
         ocr_results = []
-        for _, row in ocr_df.iterrows():
-            if str(row['text']).strip():
-                # Formato: (palabra, box)
-                box = [row['left'], row['top'], row['left'] + row['width'], row['top'] + row['height']]
-                ocr_results.append((row['text'], box))
+        try:
+            api.SetImage(image)
+            api.Recognize()
+            iterator = api.GetIterator()
+            
+            # Crear lista de resultados OCR con formato esperado por LayoutLM, conservando
+            # solo las palabras con texto y confianza suficiente, y descartando signos de
+            # puntuación sueltos
+            dropped = 0
+            if iterator is not None:
+                level = tesserocr.RIL.WORD
+                for word in tesserocr.iterate_level(iterator, level):
+                    text = word.GetUTF8Text(level)
+                    if not text or not text.strip():
+                        continue
+                    if (word.Confidence(level) < self.min_conf or
+                            (len(text) == 1 and not text.isalnum())):
+                        dropped += 1
+                        continue
+                    # Formato: (palabra, box)
+                    ocr_results.append((text, list(word.BoundingBox(level))))
+        finally:
+            self._tess_pool.put(api)
         
+        logger.debug(f"OCR filtrado: {len(ocr_results)} palabras conservadas, {dropped} descartadas")
         logger.info(f"OCR completado: {len(ocr_results)} palabras detectadas")
         return ocr_results
     
-    def _save_ocr_results(self, ocr_results, output_path):
+    def _perform_ocr_cached(self, file_path, load_image):
+        """
+        Aplica OCR a la primera página de un documento reutilizando, si hay caché, el
+        resultado guardado para un archivo con el mismo contenido
+        
+        Args:
+            file_path: Ruta al documento original, cuyo contenido identifica la entrada
+            load_image: Función sin argumentos que devuelve la imagen PIL de la primera página;
+                solo se llama si el resultado no está en la caché
+            
+        Returns:
+            list: Lista de tuplas (palabra, [x0, y0, x1, y1])
+        """
+        if not self.cache_dir:
+            return self._perform_ocr(load_image())
+        
+        # El resultado depende del contenido del archivo, del umbral de confianza y de la
+        # configuración de Tesseract; las cajas son coordenadas en píxeles de la imagen, así
+        # que dependen también de la resolución y del tamaño máximo de la rasterización
+        hasher = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(chunk)
+        hasher.update(
+            f"min_conf={self.min_conf};dpi={_PDF_DPI};max_side={_MAX_OCR_SIDE};"
+            f"lang={_TESS_LANG};psm={_TESS_PSM}".encode()
+        )
+        cache_path = os.path.join(self.cache_dir, f"{hasher.hexdigest()}.pkl")
+        
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, "rb") as f:
+                    ocr_results = pickle.load(f)
+                logger.info(f"Resultados del OCR leídos de la caché: {cache_path}")
+                return ocr_results
+            except Exception as e:
+                logger.warning(f"No se pudo leer la caché del OCR {cache_path}: {e}")
+        
+        ocr_results = self._perform_ocr(load_image())
+        
+        # Escribir en un archivo temporal y renombrarlo, para que otro proceso que use la
+        # misma caché nunca lea una entrada a medio escribir
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(ocr_results, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+        
+        return ocr_results
+    
+    def _create_tess_api(self):
+        """
+        Crea una instancia de Tesseract en proceso con segmentación automática de página
+        (la misma configuración por defecto que la línea de comandos de Tesseract)
+        """
+        api = tesserocr.PyTessBaseAPI(lang=_TESS_LANG, psm=_TESS_PSM)
+        self._tess_apis.append(api)
+        return api
+    
+    def _save_ocr_results(self, ocr_results, output_path, human_readable=False):
         """
-        Guarda los resultados del OCR en un archivo de texto para análisis
+        Guarda los resultados del OCR en un archivo para análisis
+        
+        Por defecto se escribe un .npz comprimido con el array de palabras ("words") y el de
+        cajas ("boxes"), que se lee con numpy.load sin necesidad de pickle.
         
         Args:
             ocr_results: Resultados del OCR
             output_path: Ruta donde guardar el archivo
+            human_readable: Si es True, guarda el texto completo y las palabras con sus
+                posiciones en JSON, legible pero mucho más grande y lento de escribir
         """
         logger.info(f"Guardando resultados del OCR en {output_path}")
         
+        if not human_readable:
+            # Guardar en formato binario comprimido, serializando cada array en una sola llamada
+            with open(output_path, "wb") as f:
+                np.savez_compressed(
+                    f,
+                    words=np.array([word for word, _ in ocr_results], dtype=str),
+                    boxes=np.asarray([box for _, box in ocr_results], dtype=np.int32).reshape(-1, 4)
+                )
+            logger.info(f"Resultados del OCR guardados en {output_path}")
+            return
+        
         # Crear texto plano con todas las palabras
         full_text = " ".join([word for word, _ in ocr_results])
         
@@ -109,12 +468,16 @@ class DocumentProcessor:
             "words": [{"text": word, "box": box} for word, box in ocr_results]
         }
         
-        # Guardar en formato JSON para análisis posterior
+        # Guardar en formato JSON para análisis posterior, componiendo todo el contenido
+        # en memoria y escribiéndolo de una sola vez
+        content = "".join([
+            "=== TEXTO COMPLETO ===\n",
+            full_text,
+            "\n\n=== PALABRAS Y POSICIONES ===\n",
+            json.dumps(ocr_data["words"], indent=2)
+        ])
         with open(output_path, "w") as f:
-            f.write("=== TEXTO COMPLETO ===\n")
-            f.write(full_text)
-            f.write("\n\n=== PALABRAS Y POSICIONES ===\n")
-            json.dump(ocr_data["words"], f, indent=2)
+            f.write(content)
         
         logger.info(f"Resultados del OCR guardados en {output_path}")
         
@@ -129,31 +492,114 @@ class DocumentProcessor:
         Returns:
             dict: Entradas procesadas para el modelo
         """
+        words, normalized_boxes = self._words_and_boxes(image, ocr_results)
+        
+        # Tokenizar palabras y cajas con el tokenizador del procesador de LayoutLM, y añadir
+        # la imagen ya preparada en lugar de pasarla por su extractor de características
+        encoding = self.processor.tokenizer(
+            words,
+            boxes=normalized_boxes,
+            return_tensors="pt",
+            padding=self.padding,
+            truncation=True,
+            max_length=self.max_length
+        )
+        encoding["image"] = torch.from_numpy(self._prepare_image(image)[np.newaxis])
+        
+        return encoding
+    
+    def _prepare_for_layoutlm_batch(self, images, ocr_results_list):
+        """
+        Prepara los datos de varios documentos para el modelo LayoutLM en un único lote
+        
+        Args:
+            images: Lista de imágenes PIL
+            ocr_results_list: Lista de resultados del OCR, en el mismo orden
+            
+        Returns:
+            dict: Entradas procesadas para el modelo, con una fila por documento y las
+            secuencias rellenadas solo hasta la más larga del lote
+        """
+        words_list = []
+        boxes_list = []
+        for image, ocr_results in zip(images, ocr_results_list):
+            words, normalized_boxes = self._words_and_boxes(image, ocr_results)
+            words_list.append(words)
+            boxes_list.append(normalized_boxes)
+        
+        # Tokenizar todos los documentos en una sola llamada al tokenizador
+        encoding = self.processor.tokenizer(
+            words_list,
+            boxes=boxes_list,
+            return_tensors="pt",
+            padding=self.padding,
+            truncation=True,
+            max_length=self.max_length
+        )
+        encoding["image"] = torch.from_numpy(np.stack([self._prepare_image(image) for image in images]))
+        
+        return encoding
+    
+    def _words_and_boxes(self, image, ocr_results):
+        """
+        Separa palabras y cajas del OCR y normaliza las cajas al formato de LayoutLMv2
+        
+        Args:
+            image: Imagen PIL
+            ocr_results: Resultados del OCR
+            
+        Returns:
+            list: Palabras
+            list: Cajas normalizadas entre 0 y 1000
+        """
         # Extraer solo las palabras y cajas
         words = [result[0] for result in ocr_results]
         boxes = [result[1] for result in ocr_results]
         
         # Normalizar las cajas al formato que espera LayoutLMv2 
-        # (convertir a coordenadas normalizadas entre 0 y 1000)
-        normalized_boxes = []
+        # (convertir a coordenadas normalizadas entre 0 y 1000), todas a la vez y recortando
+        # las que sobresalen de la imagen, que LayoutLMv2 rechaza
         width, height = image.size
-        for box in boxes:
-            normalized_box = [
-                int(1000 * box[0] / width),
-                int(1000 * box[1] / height),
-                int(1000 * box[2] / width),
-                int(1000 * box[3] / height)
-            ]
-            normalized_boxes.append(normalized_box)
-        
-        # Usar el procesador de LayoutLM para crear entradas del modelo
-        encoding = self.processor(
-            image,
-            words,
-            boxes=normalized_boxes,
-            return_tensors="pt",
-            padding="max_length",
-            truncation=True
-        )
+        dims = np.array([width, height, width, height], dtype=np.int64)
+        normalized_boxes = np.clip(
+            np.asarray(boxes, dtype=np.int64).reshape(-1, 4) * 1000 // dims, 0, 1000
+        ).tolist()
         
-        return encoding
\ No newline at end of file
+        return words, normalized_boxes
+    
+    def _prepare_image(self, image):
+        """
+        Prepara la imagen para la rama visual de LayoutLMv2, igual que su extractor de
+        características: redimensión bilineal a 224x224, canales en orden BGR y primero
+        
+        Args:
+            image: Imagen PIL
+            
+        Returns:
+            numpy.ndarray: Array uint8 de forma (3, 224, 224)
+        """
+        resized = image.convert("RGB").resize((_IMAGE_SIZE, _IMAGE_SIZE), Image.BILINEAR)
+        return np.ascontiguousarray(np.asarray(resized)[:, :, ::-1].transpose(2, 0, 1))
+    
+    def to_device(self, encoding):
+        """
+        Envía las entradas del modelo al dispositivo del procesador
+        
+        Con GPU, los tensores se fijan en memoria (pinned) antes de copiarlos, de modo que la
+        copia es no bloqueante: para solaparla con otro trabajo en la GPU, llamar a este
+        método dentro de un torch.cuda.Stream dedicado y sincronizar antes de usar el resultado.
+        Se fijan aquí y no al preparar las entradas porque fijar memoria crea un contexto CUDA,
+        que no necesitan los procesos que solo hacen OCR o no usan la GPU.
+        
+        Args:
+            encoding: Entradas procesadas para el modelo
+            
+        Returns:
+            dict: Las mismas entradas, con los tensores en self.device
+        """
+        pin = self.device.type == "cuda"
+        return {
+            key: (value.pin_memory() if pin else value).to(self.device, non_blocking=True)
+            if isinstance(value, torch.Tensor) else value
+            for key, value in encoding.items()
+        }
\ No newline at end of file